@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+## Fingerprint database start-up cost: json.load of the JSON databases parser() reads, plus the cold start of
+## 'import ise_pyshark; parser()' in a fresh interpreter
+import os
+import sys
+import json
+import time
+import statistics
+import argparse
+import subprocess
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+db_files = ['apple-os.json', 'models.json', 'androids.json']
+cold_start = 'import time; start = time.perf_counter(); import ise_pyshark; ise_pyshark.parser(); print(time.perf_counter() - start)'
+
+def median_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+def load_json():
+    data = {}
+    for name in db_files:
+        with open(os.path.join(repo_dir, 'ise_pyshark', 'db', name), 'rb') as file:
+            data[name] = json.load(file)
+    return data
+
+def cold_start_ms(tree):
+    env = dict(os.environ, PYTHONPATH=tree)
+    output = subprocess.run([sys.executable, '-c', cold_start], env=env, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1]) * 1000
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark fingerprint database start-up.')
+    argparser.add_argument('-r', '--repeat', type=int, default=5, help='runs per measurement (median reported)')
+    argparser.add_argument('--baseline', help='checkout of an older tree to time the cold start against (ex. from git worktree)')
+    args = argparser.parse_args()
+
+    print(f'json.load of the databases:    {median_ms(load_json, args.repeat):.1f} ms')
+    print(f'cold start, import + parser(): {statistics.median(cold_start_ms(repo_dir) for _ in range(args.repeat)):.0f} ms')
+    if args.baseline:
+        print(f'baseline cold start:           {statistics.median(cold_start_ms(args.baseline) for _ in range(args.repeat)):.0f} ms')
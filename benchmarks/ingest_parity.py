@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+## Parity and throughput of the two tshark ingest engines: pyshark's full JSON dissection vs fieldcapture's field extraction
+## Fixture mode (default) needs no tshark: the same packets as pyshark JSON and as 'tshark -T ek -e ...' output
+## (benchmarks/fixtures/ingest_packets.json) must give identical parser results; also times the Python-side decode + parse.
+## --pcap runs tshark both ways over a capture file, compares every packet's parser results and reports packets/sec.
+import os
+import sys
+import json
+import time
+import argparse
+from pyshark.tshark.output_parser.tshark_json import packet_from_json_packet
+from ise_pyshark import parser, fieldcapture
+
+fixtures_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ingest_packets.json')
+## Highest layers the collector never hands to the parsers (see capture_live_packets)
+skipped_layers = ['DATA_RAW', 'TCP_RAW', 'UDP_RAW', 'JSON_RAW', 'DATA-TEXT-LINES_RAW', 'IMAGE-GIF_RAW', 'IMAGE-JFIF_RAW', 'PNG-RAW']
+
+packet_parser = parser()
+packet_callbacks = {
+    'mdns': packet_parser.parse_mdns_v8,
+    'xml': packet_parser.parse_xml,
+    'sip': packet_parser.parse_sip,
+    'ssdp': packet_parser.parse_ssdp,
+    'http': packet_parser.parse_http,
+    'browser': packet_parser.parse_smb_browser,
+}
+
+## Same dispatch as the collector's process_packet; returns (highest layer, [parser results])
+def parse(packet):
+    highest_layer = packet.highest_layer
+    results = []
+    if '_' in highest_layer and highest_layer not in skipped_layers:
+        if highest_layer.split('_')[0] == 'XML':
+            results.append(packet_parser.parse_xml(packet))
+        else:
+            for layer in packet.layers:
+                callback = packet_callbacks.get(layer.layer_name)
+                if callback is not None:
+                    results.append(callback(packet))
+    return highest_layer, results
+
+def pyshark_packet(layers):
+    return packet_from_json_packet(json.dumps({'_source': {'layers': layers}}).encode())
+
+def ek_packet(layers):
+    return fieldcapture.packet_from_ek(json.loads(json.dumps({'layers': layers}))['layers'])
+
+def rate(function, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            parse(function(item))
+    return len(items) * repeat / (time.perf_counter() - start)
+
+def fixture_parity(repeat):
+    with open(fixtures_file) as file:
+        fixtures = json.load(file)
+    mismatches = 0
+    for fixture in fixtures:
+        expected = parse(pyshark_packet(fixture['pyshark_json']))
+        result = parse(ek_packet(fixture['ek']))
+        if result != expected:
+            mismatches += 1
+            print(f"MISMATCH {fixture['name']}:\n  pyshark: {expected}\n  fields:  {result}")
+        else:
+            print(f"ok       {fixture['name']}: {expected[0]}")
+    print(f'fixture parity: {len(fixtures)} packets, {mismatches} mismatches')
+    ## Python-side cost only (tshark's own dissection / output cost is measured by --pcap)
+    full = rate(pyshark_packet, [fixture['pyshark_json'] for fixture in fixtures], repeat)
+    fields = rate(ek_packet, [fixture['ek'] for fixture in fixtures], repeat)
+    print(f'decode + parse: pyshark JSON {full:,.0f} packets/sec, field extraction {fields:,.0f} packets/sec ({fields / full:.1f}x)')
+    return mismatches
+
+## Run tshark both ways over 'pcap'; returns (parsed packets, seconds) per engine
+def pcap_run(capture):
+    results = []
+    start = time.perf_counter()
+    for packet in capture:
+        results.append(parse(packet))
+    return results, time.perf_counter() - start
+
+def pcap_parity(pcap, display_filter):
+    import pyshark
+    full_capture = pyshark.FileCapture(pcap, display_filter=display_filter, include_raw=True, use_json=True)
+    full, full_seconds = pcap_run(full_capture)
+    full_capture.close()
+    fields, fields_seconds = pcap_run(fieldcapture(input_file=pcap, display_filter=display_filter))
+    mismatches = sum(1 for a, b in zip(full, fields) if a != b) + abs(len(full) - len(fields))
+    print(f'{pcap}: {len(full)} / {len(fields)} packets, {mismatches} mismatches')
+    print(f'pyshark JSON {len(full) / full_seconds:,.0f} packets/sec, field extraction {len(fields) / fields_seconds:,.0f} packets/sec '
+          f'({full_seconds / fields_seconds:.1f}x)')
+    return mismatches
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Compare the pyshark and field-extraction ingest engines.')
+    argparser.add_argument('--pcap', action='append', default=[], help='capture file to run through tshark both ways (repeatable; needs tshark)')
+    argparser.add_argument('--display-filter', default=None, help='tshark display filter applied in --pcap runs')
+    argparser.add_argument('-r', '--repeat', type=int, default=2000, help='passes over the fixtures when timing')
+    args = argparser.parse_args()
+
+    mismatches = fixture_parity(args.repeat)
+    for pcap in args.pcap:
+        mismatches += pcap_parity(pcap, args.display_filter)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+## End-to-end ISE sync benchmark: drives the live collector's update_ise_endpoints_async against a local mock ISE
+## NOTE: uses db 0 / 1 and the outbox db of the target redis-server and flushes them; point it at a scratch instance
+import os
+import sys
+import time
+import types
+import random
+import asyncio
+import argparse
+import importlib.util
+import redis
+from ise_pyshark import eps, apis, outbox, batcher, isemirror
+from mockise import mockise
+
+collector_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ise-pyshark.py')
+protocols = ['mDNS', 'HTTP', 'SSDP', 'SIP']
+
+## Import the live collector script as a module so its sync loop can be driven directly
+def load_collector():
+    spec = importlib.util.spec_from_file_location('ise_pyshark_collector', collector_path)
+    collector = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(collector)
+    return collector
+
+def scratch_eps(redis_db):
+    instance = eps.__new__(eps)
+    instance.local_db = redis_db
+    instance._register_scripts()
+    return instance
+
+def mac_address(i):
+    return '02:%02x:%02x:%02x:%02x:%02x' % (i >> 32 & 255, i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255)
+
+## Synthetic collector observations (value array layout used by parser / eps)
+def observation(i):
+    values = [mac_address(i), random.choice(protocols), f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', '',
+              f'host-{i}', random.choice(['Apple', 'Sonos', 'Roku', 'HP']), f'model-{i % 50}', '', '', '', 'phone']
+    return values + ['0'] + [str(random.choice([10, 30, 50, 80])) for _ in range(7)]
+
+## ISE side of the test: a share of endpoints already known with values, known without values, or unknown
+def ise_endpoints(count, known, populated):
+    endpoints = {}
+    for i in range(count):
+        roll = random.random()
+        if roll < populated:
+            endpoints[mac_address(i)] = {name: '' for name in ('isepyProtocols', 'isepyType', 'isepyDeviceID', 'isepyIP', 'isepyOS',
+                                                               'isepyVendor', 'isepyModel', 'isepyHostname', 'isepySerial')}
+            endpoints[mac_address(i)]['isepyCertainty'] = '0,0,0,0,0,0,0'
+        elif roll < known:
+            endpoints[mac_address(i)] = None
+    return endpoints
+
+def run(collector, args, redis_dbs, count):
+    local_db, remote_db, outbox_db = redis_dbs
+    for redis_db in redis_dbs:
+        redis_db.flushdb()
+    ise = mockise(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, rate_limit=args.rate_limit).start()
+    ise.load(ise_endpoints(count, args.known, args.populated))
+
+    redis_eps = scratch_eps(local_db)
+    batch = [observation(i) for i in range(count)]
+    for i in range(0, count, 1000):
+        redis_eps.add_or_update_entries(local_db, batch[i:i + 1000])
+
+    collector.redis_eps = redis_eps
+    collector.ise_apis = apis(ise.url, 'admin', 'admin', collector.headers, pool_size=args.concurrency,
+                              read_rate=args.read_rate, write_rate=args.write_rate)
+    collector.ise_outbox = outbox(outbox_db)
+    collector.ise_batcher = batcher()
+    collector.ise_mirror = isemirror(collector.ise_apis, page_size=args.page_size) if args.mirror else None
+    collector.args = types.SimpleNamespace(api_concurrency=args.concurrency)
+
+    async def cycle():
+        if collector.ise_mirror is not None:
+            await collector.ise_mirror.load()
+        start = time.perf_counter()
+        await collector.update_ise_endpoints_async(local_db, remote_db)
+        elapsed = time.perf_counter() - start
+        await collector.ise_apis.close_async()
+        return elapsed
+
+    elapsed = asyncio.run(cycle())
+    stats = ise.stats()
+    ise.stop()
+    return elapsed, stats, collector.ise_outbox.stats()
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark one ISE sync cycle against a local mock ISE server.')
+    argparser.add_argument('--host', default='localhost', help='redis-server host')
+    argparser.add_argument('--port', type=int, default=6379, help='redis-server port')
+    argparser.add_argument('--outbox-db', type=int, default=2)
+    argparser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated synthetic endpoint counts')
+    argparser.add_argument('--latency', type=float, default=0.02, help='mock ISE seconds per response')
+    argparser.add_argument('--jitter', type=float, default=0.0, help='mock ISE random extra seconds per response')
+    argparser.add_argument('--error-rate', type=float, default=0.0, help='mock ISE fraction of HTTP 500 responses')
+    argparser.add_argument('--rate-limit', type=int, default=0, help='mock ISE requests/sec before HTTP 429')
+    argparser.add_argument('--known', type=float, default=0.75, help='fraction of endpoints already known to ISE')
+    argparser.add_argument('--populated', type=float, default=0.5, help='fraction of endpoints with isepy attributes in ISE')
+    argparser.add_argument('--concurrency', type=int, default=20, help='ISE lookups in flight')
+    argparser.add_argument('--read-rate', type=float, default=0, help='client read requests/sec (0 = unlimited)')
+    argparser.add_argument('--write-rate', type=float, default=0, help='client write requests/sec (0 = unlimited)')
+    argparser.add_argument('--mirror', action='store_true', help='prefetch ISE endpoints into the mirror before the cycle')
+    argparser.add_argument('--page-size', type=int, default=100, help='mirror page size')
+    args = argparser.parse_args()
+
+    ## eps identifies the local (array-based) db by its db number, so observations must go to db 0
+    redis_dbs = (redis.Redis(host=args.host, port=args.port, db=0), redis.Redis(host=args.host, port=args.port, db=1),
+                 redis.Redis(host=args.host, port=args.port, db=args.outbox_db))
+    collector = load_collector()
+    print(f"{'endpoints':>10} {'cycle sec':>10} {'endpoints/sec':>14} {'API calls':>10} {'KB sent':>10} {'KB received':>12}  calls by route")
+    for count in [int(size) for size in args.sizes.split(',')]:
+        elapsed, stats, queued = run(collector, args, redis_dbs, count)
+        print(f"{count:>10} {elapsed:>10.2f} {count / elapsed:>14,.0f} {stats['api_calls']:>10} {stats['bytes_received'] / 1024:>10,.0f} "
+              f"{stats['bytes_sent'] / 1024:>12,.0f}  {stats['calls']}")
+        if queued['pending']:
+            print(f'{"":>10} {queued["pending"]} endpoint updates left in the outbox')
+    for redis_db in redis_dbs:
+        redis_db.flushdb()
+    sys.exit(0)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+## Local mock ISE API server for the benchmarks; also runs standalone to point a collector at
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from ise_pyshark.apis import ise_attributes
+
+logger = logging.getLogger(__name__)
+
+endpoint_path = re.compile(r'^/api/v1/endpoint/([^/]+)$')
+
+## Local stand-in for the ISE OpenAPI endpoints used by apis (plain HTTP, no authentication checks)
+class mockise:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        ## Requests per second accepted before answering 429 (0 = unlimited)
+        self.rate_limit = rate_limit
+        ## mac (uppercase) -> endpoint record
+        self.endpoints = {}
+        self.attributes = [{'attributeName': name, 'attributeType': type} for name, type in ise_attributes.items()]
+        self.lock = threading.Lock()
+        self.window = (0, 0)
+        self.reset_stats()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.errors = 0
+            self.throttled = 0
+
+    ## Seed endpoints as the ISE side of a test: {mac: custom attributes dict or None}
+    def load(self, endpoints):
+        with self.lock:
+            for mac, custom_attributes in endpoints.items():
+                self.endpoints[mac.upper()] = {'mac': mac.upper(), 'customAttributes': custom_attributes}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-ise', daemon=True)
+        self.thread.start()
+        logger.debug(f'mock ISE listening on {self.url}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'api_calls': sum(self.calls.values()), 'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent, 'errors': self.errors, 'throttled': self.throttled, 'endpoints': len(self.endpoints)}
+
+    ## Decide whether to delay, throttle or fail a request; returns the status code to force, if any
+    def _admit(self, route):
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            if self.rate_limit:
+                second, count = self.window
+                now = int(time.monotonic())
+                count = count + 1 if now == second else 1
+                self.window = (now, count)
+                if count > self.rate_limit:
+                    self.throttled += 1
+                    return 429
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return 500
+        delay = self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+        if delay:
+            time.sleep(delay)
+        return None
+
+    def _bulk(self, body):
+        with self.lock:
+            for update in body:
+                mac = update['mac'].upper()
+                record = self.endpoints.get(mac)
+                if record is None:
+                    record = self.endpoints[mac] = {'mac': mac, 'customAttributes': None}
+                record['customAttributes'] = dict(update.get('customAttributes') or {})
+        return {'id': f'bulk-{random.getrandbits(32):08x}'}
+
+    def _handler(self):
+        ise = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _reply(self, status, result=None):
+                body = json.dumps(result).encode('utf-8') if result is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with ise.lock:
+                    ise.bytes_sent += len(body)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                data = self.rfile.read(length) if length else b''
+                with ise.lock:
+                    ise.bytes_received += length + len(str(self.headers)) + len(self.requestline) + 2
+                return json.loads(data) if data else None
+
+            def _route(self, method):
+                url = urlparse(self.path)
+                body = self._body()
+                if url.path == '/api/v1/endpoint-custom-attribute':
+                    route = f'{method} endpoint-custom-attribute'
+                elif url.path == '/api/v1/endpoint/bulk':
+                    route = f'{method} endpoint/bulk'
+                elif url.path == '/api/v1/endpoint':
+                    route = f'{method} endpoint'
+                elif endpoint_path.match(url.path):
+                    route = f'{method} endpoint/{{mac}}'
+                else:
+                    return self._reply(404, {'message': 'not found'})
+                forced = ise._admit(route)
+                if forced is not None:
+                    return self._reply(forced, {'message': 'mock ISE injected failure'})
+
+                if route == 'GET endpoint-custom-attribute':
+                    return self._reply(200, ise.attributes)
+                if route == 'POST endpoint-custom-attribute':
+                    with ise.lock:
+                        ise.attributes.append(body)
+                    return self._reply(201, body)
+                if route == 'GET endpoint':
+                    query = parse_qs(url.query)
+                    page = int(query.get('page', ['1'])[0])
+                    size = int(query.get('size', ['20'])[0])
+                    with ise.lock:
+                        records = list(ise.endpoints.values())[(page - 1) * size:page * size]
+                    return self._reply(200, records)
+                if route in ('PUT endpoint/bulk', 'POST endpoint/bulk'):
+                    return self._reply(200, ise._bulk(body or []))
+                if route == 'GET endpoint/{mac}':
+                    mac = endpoint_path.match(url.path).group(1).upper()
+                    with ise.lock:
+                        record = ise.endpoints.get(mac)
+                    if record is None:
+                        return self._reply(404, {'message': f'endpoint {mac} not found'})
+                    return self._reply(200, record)
+                return self._reply(405, {'message': 'method not allowed'})
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_PUT(self):
+                self._route('PUT')
+
+            def do_POST(self):
+                self._route('POST')
+
+        return handler
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Run a local mock ISE API server.')
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', type=int, default=9060)
+    argparser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    argparser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds (0..jitter) per response')
+    argparser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500')
+    argparser.add_argument('--rate-limit', type=int, default=0, help='requests per second before answering HTTP 429')
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = mockise(args.host, args.port, args.latency, args.jitter, args.error_rate, args.rate_limit).start()
+    print(f'mock ISE listening on {server.url} (Ctrl-C to stop)')
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+    sys.exit(0)
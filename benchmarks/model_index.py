@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+## models.json lookup: the original nested vendor x model scan vs modelindex, with a differential check over
+## every models.json model text against every vendor key, case / suffix variants and real OUI vendor names
+import os
+import json
+import time
+import random
+import argparse
+from ise_pyshark import modelindex, ouidb
+
+macoui_url = 'https://standards-oui.ieee.org/'
+models_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ise_pyshark', 'db', 'models.json')
+
+## The original parse_model_and_os loop: first vendor (in file order) prefixing the OUI name whose models hold 'txt'
+def linear_lookup(models_data, vendor_string, txt):
+    for oui, models in models_data.items():
+        if vendor_string.lower().startswith(oui.lower()):
+            for model, result in models.items():
+                if txt == model:
+                    return result
+    return None
+
+def rate(function, pairs):
+    start = time.perf_counter()
+    for vendor_string, txt in pairs:
+        function(vendor_string, txt)
+    return len(pairs) / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark and check the models.json index against the linear scan.')
+    argparser.add_argument('-n', '--count', type=int, default=20000, help='number of lookups per benchmark')
+    argparser.add_argument('--oui-vendors', type=int, default=3000, help='number of OUI vendor names in the differential check')
+    argparser.add_argument('--seed', type=int, default=1)
+    args = argparser.parse_args()
+    random.seed(args.seed)
+
+    with open(models_file, 'rb') as file:
+        models_data = json.load(file)
+    index = modelindex(models_data)
+    oui_vendors = sorted(set(ouidb(macoui_url, 'db/macoui.txt', 'db/macoui.pipe', 'db/macoui.db', 'db/macoui.bin').oui_index[24].values()))
+    oui_vendors = random.sample(oui_vendors, min(args.oui_vendors, len(oui_vendors)))
+
+    texts = sorted({model for models in models_data.values() for model in models}) + ['', 'no-such-model', 'model=unknown']
+    vendors = []
+    for vendor in models_data:
+        vendors += [vendor, vendor.lower(), vendor.upper(), vendor + ' Inc.', vendor + ', Ltd', vendor[:-1]]
+    vendors += oui_vendors + ['']
+
+    mismatches = 0
+    for vendor_string in vendors:
+        for txt in texts:
+            if index.lookup(vendor_string, txt) != linear_lookup(models_data, vendor_string, txt):
+                mismatches += 1
+    print(f'differential check: {len(vendors) * len(texts):,} vendor / model pairs, {mismatches} mismatches')
+
+    matching = [vendor for vendor in vendors if index.matching_vendors(vendor)]
+    for label, pool in (('random vendors', oui_vendors), ('matching vendors', matching)):
+        pairs = [(random.choice(pool), random.choice(texts)) for _ in range(args.count)]
+        linear = rate(lambda vendor_string, txt: linear_lookup(models_data, vendor_string, txt), pairs)
+        indexed = rate(index.lookup, pairs)
+        print(f'{label}: {linear:,.0f}/sec linear -> {indexed:,.0f}/sec indexed')
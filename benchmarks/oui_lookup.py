@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+## OUI lookup throughput: one sqlite connection per lookup (the original query_mac_address) vs the in-memory index
+## Also checks that both return the same vendor for every prefix in the shipped macoui.db
+import time
+import random
+import sqlite3
+import argparse
+from ise_pyshark import ouidb
+
+macoui_url = 'https://standards-oui.ieee.org/'
+
+## The original per-packet lookup: connect, SELECT, close
+def sqlite_lookup(database_file, mac_address):
+    connection = sqlite3.connect(database_file)
+    cursor = connection.cursor()
+    cursor.execute('SELECT OrgName FROM macoui WHERE OUI = ?', (mac_address,))
+    result = cursor.fetchone()
+    connection.close()
+    return result[0] if result else None
+
+def rate(function, prefixes):
+    start = time.perf_counter()
+    for prefix in prefixes:
+        function(prefix)
+    return len(prefixes) / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark OUI lookups: sqlite per lookup vs in-memory index.')
+    argparser.add_argument('-n', '--count', type=int, default=20000, help='number of lookups')
+    argparser.add_argument('--seed', type=int, default=1)
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    manager = ouidb(macoui_url, 'db/macoui.txt', 'db/macoui.pipe', 'db/macoui.db', 'db/macoui.bin')
+    print(f'index load: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    connection = sqlite3.connect(manager.database_file)
+    ouis = [oui for (oui,) in connection.execute('SELECT OUI FROM macoui')]
+    connection.close()
+
+    ## Differential check over every row (first row wins for duplicate OUIs, as with fetchone)
+    mismatches = sum(1 for oui in set(ouis) if sqlite_lookup(manager.database_file, oui) != manager.query_mac_address(oui))
+    print(f'differential check: {len(set(ouis))} prefixes, {mismatches} mismatches')
+
+    random.seed(args.seed)
+    ## Mix of known prefixes and random (mostly unknown) ones, as seen on the wire
+    prefixes = [random.choice(ouis) if random.random() < 0.5 else '%06X' % random.getrandbits(24) for _ in range(args.count)]
+    print(f'sqlite connection per lookup: {rate(lambda prefix: sqlite_lookup(manager.database_file, prefix), prefixes):,.0f} lookups/sec')
+    print(f'in-memory index:              {rate(manager.query_mac_address, prefixes):,.0f} lookups/sec')
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+## Throughput of eps.add_or_update_entry against a local redis-server: server-side merge script vs client-side merge
+## NOTE: uses db 0 of the target redis-server and flushes it; point it at a scratch instance, not a live collector
+import time
+import random
+import argparse
+import redis
+from ise_pyshark import eps
+
+protocols = ['mDNS', 'HTTP', 'SSDP', 'SIP', 'XML', 'SMB']
+
+## Build an eps instance bound to 'redis_db' without the constructor's flush / example records
+def scratch_eps(redis_db, use_script):
+    instance = eps.__new__(eps)
+    instance.local_db = redis_db
+    instance._register_scripts()
+    instance.use_merge_script = use_script
+    return instance
+
+def observations(count, endpoints):
+    macs = ['02:00:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(endpoints)]
+    for _ in range(count):
+        values = [random.choice(macs), random.choice(protocols), '10.0.0.1'] + [random.choice(['', 'a', 'b']) for _ in range(8)]
+        values += [str(random.choice([0, 10, 30, 50, 80])) for _ in range(8)]
+        yield values
+
+def run(redis_db, use_script, count, endpoints):
+    redis_db.flushdb()
+    instance = scratch_eps(redis_db, use_script)
+    data = list(observations(count, endpoints))
+    start = time.perf_counter()
+    for values in data:
+        instance.add_or_update_entry(redis_db, values)
+    elapsed = time.perf_counter() - start
+    redis_db.flushdb()
+    return count / elapsed
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark redis endpoint merge throughput.')
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('--port', type=int, default=6379)
+    argparser.add_argument('-n', '--count', type=int, default=50000, help='number of observations')
+    argparser.add_argument('-e', '--endpoints', type=int, default=2000, help='number of distinct MAC addresses')
+    args = argparser.parse_args()
+
+    ## eps identifies the local (array-based) db by its db number, so observations must go to db 0
+    redis_db = redis.Redis(host=args.host, port=args.port, db=0)
+    for label, use_script in (('client-side merge (HGETALL + MULTI)', False), ('server-side merge (EVALSHA)', True)):
+        rate = run(redis_db, use_script, args.count, args.endpoints)
+        print(f'{label}: {rate:,.0f} observations/sec')
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+## Native decoder throughput across --workers counts: a capture file is split by endpoint MAC (the last octet of the
+## mirrored frame's source MAC for ERSPAN, of the frame's own source MAC otherwise, as worker_bpf_filter does in the
+## kernel) and each worker process decodes and parses its share in parallel. Without --pcap a synthetic capture of
+## mDNS and SSDP announcements, half of them ERSPAN type II / III mirrored, is generated.
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import argparse
+import tempfile
+import multiprocessing
+from ise_pyshark import parser, rawcapture, unknownmodels
+
+packet_parser = parser()
+packet_callbacks = {
+    'mdns': packet_parser.parse_mdns_v8,
+    'ssdp': packet_parser.parse_ssdp,
+    'browser': packet_parser.parse_smb_browser,
+}
+
+## Synthetic frames, from endpoints with real vendor OUIs (Apple, Raspberry Pi, VMware, Samsung, Sonos)
+vendor_ouis = ['a4:83:e7', '3c:22:fb', 'f0:18:98', 'b8:27:eb', '00:50:56', '8c:79:f5', '5c:aa:fd']
+
+def eth(src, payload, vlan=None):
+    header = bytes.fromhex('01005e0000fb') + bytes.fromhex(src.replace(':', ''))
+    if vlan is not None:
+        header += struct.pack('!HH', 0x8100, vlan)
+    return header + struct.pack('!H', 0x0800) + payload
+
+def ipv4(src, payload, proto=17):
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 1, 0, 255, proto, 0, socket.inet_aton(src), socket.inet_aton('224.0.0.251')) + payload
+
+def udp(port, payload):
+    return struct.pack('!HHHH', port, port, 8 + len(payload), 0) + payload
+
+def mdns(hostname, model):
+    def name(text):
+        return b''.join(bytes([len(label)]) + label.encode() for label in text.split('.')) + b'\0'
+    def txt(*strings):
+        return b''.join(bytes([len(value)]) + value.encode() for value in strings)
+    def record(owner, rtype, data):
+        return name(owner) + struct.pack('!HHIH', rtype, 0x8001, 120, len(data)) + data
+    answers = [record(f'{hostname}.local', 1, socket.inet_aton('10.0.0.5')),
+               record(f'{hostname}._device-info._tcp.local', 16, txt(f'model={model}', 'osxvers=23'))]
+    return struct.pack('!HHHHHH', 0, 0x8400, 0, len(answers), 0, 0) + b''.join(answers)
+
+def ssdp(user_agent):
+    return f'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nUSER-AGENT: {user_agent}\r\nNTS: ssdp:alive\r\n\r\n'.encode()
+
+def erspan(kind, inner):
+    if kind == 'II':
+        header = struct.pack('!HHI', 0x1000, 0x88be, 7) + struct.pack('!II', 0x10000001, 0)
+    else:
+        header = struct.pack('!HHI', 0x1000, 0x22eb, 7) + struct.pack('!IIHH', 0x20000001, 0, 0, 0)
+    return eth('00:00:00:00:00:01', ipv4('1.1.1.1', header + inner, proto=47))
+
+def synthetic_frames(count, endpoints):
+    macs = [random.choice(vendor_ouis) + ''.join(f':{random.randrange(256):02x}' for _ in range(3)) for _ in range(endpoints)]
+    frames = []
+    for number in range(count):
+        mac = random.choice(macs)
+        address = f'10.{random.randrange(256)}.{random.randrange(256)}.{random.randrange(1, 255)}'
+        if number % 2:
+            payload = udp(5353, mdns(f'host-{mac[-5:].replace(":", "")}', random.choice(['MacBookPro18,3', 'iPhone14,2', 'AppleTV6,2'])))
+        else:
+            payload = udp(1900, ssdp(f'Linux/5.{number % 20} UPnP/1.0 Portable SDK for UPnP devices/1.6.{number % 30}'))
+        frame = eth(mac, ipv4(address, payload), vlan=random.choice([None, 20]))
+        if number % 4 >= 2:
+            frame = erspan(random.choice(['II', 'III']), frame)
+        frames.append(frame)
+    return frames
+
+def write_pcap(path, frames):
+    with open(path, 'wb') as file:
+        file.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for frame in frames:
+            file.write(struct.pack('<IIII', 0, 0, len(frame), len(frame)) + frame)
+
+## The octet worker_bpf_filter partitions on; frames the native decoder cannot walk go to worker 0
+def partition_octet(decoder, frame):
+    try:
+        offset = decoder._ethernet(frame, 0, [], {})
+        if offset is None:
+            return 0
+        ip_proto, offset, end = decoder._ipv4(frame, offset, [], {})
+        if ip_proto == 47:
+            offset = decoder._erspan(frame, offset, end, [])
+            return 0 if offset is None else frame[offset + 11]
+        return frame[11]
+    except (ValueError, struct.error, IndexError):
+        return 0
+
+## One capture worker: decode + parse its share of the capture, as the collector's process_packet does;
+## returns (start, end, packets, parser results). Like capture_process, each worker records unknown models in its own file.
+def worker(path):
+    packet_parser.unknown_models = unknownmodels(os.path.splitext(path)[0] + '-unknown_models.txt')
+    start = time.perf_counter()
+    packets = parsed = 0
+    for packet in rawcapture(input_file=path):
+        packets += 1
+        for layer in packet.layers:
+            callback = packet_callbacks.get(layer.layer_name)
+            if callback is None:
+                continue
+            try:
+                parsed += callback(packet) is not None
+            except Exception:
+                pass
+    return start, time.perf_counter(), packets, parsed
+
+def run(frames, workers, directory):
+    decoder = rawcapture()
+    shares = [[] for _ in range(workers)]
+    for frame in frames:
+        shares[partition_octet(decoder, frame) % workers].append(frame)
+    paths = []
+    for number, share in enumerate(shares):
+        paths.append(os.path.join(directory, f'share-{workers}-{number}.pcap'))
+        write_pcap(paths[-1], share)
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        reports = pool.map(worker, paths)
+    seconds = max(end for start, end, packets, parsed in reports) - min(start for start, end, packets, parsed in reports)
+    packets = sum(report[2] for report in reports)
+    parsed = sum(report[3] for report in reports)
+    return packets, parsed, seconds, [len(share) for share in shares]
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark the native decoder across capture worker counts.')
+    argparser.add_argument('--pcap', help='capture file to replay (default: a synthetic mDNS / SSDP capture)')
+    argparser.add_argument('-n', '--count', type=int, default=40000, help='synthetic frames')
+    argparser.add_argument('--endpoints', type=int, default=2000, help='synthetic endpoint MAC addresses')
+    argparser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to run')
+    argparser.add_argument('--seed', type=int, default=1)
+    args = argparser.parse_args()
+    random.seed(args.seed)
+
+    if args.pcap:
+        with open(args.pcap, 'rb') as file:
+            frames = [frame for linktype, frame in rawcapture.read_frames(file) if linktype == 1]
+    else:
+        frames = synthetic_frames(args.count, args.endpoints)
+    print(f'{len(frames)} frames, {os.cpu_count()} CPUs')
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = None
+        for workers in args.workers:
+            packets, parsed, seconds, shares = run(frames, workers, directory)
+            baseline = baseline or packets / seconds
+            print(f'{workers} worker(s): {packets} packets, {parsed} parsed, {packets / seconds:,.0f} packets/sec '
+                  f'({packets / seconds / baseline:.2f}x), frames per worker {shares}')
+    sys.exit(0)
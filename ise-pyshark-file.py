@@ -4,15 +4,21 @@ import redis
 import asyncio
 import ipaddress
 import logging
+import argparse
 import sys
 from pathlib import Path
 from ise_pyshark import parser
 from ise_pyshark import apis
 from ise_pyshark import eps
+from ise_pyshark import coalescer
+from ise_pyshark import fieldcapture
+from ise_pyshark import rawcapture
 
 logger = logging.getLogger(__name__)
 headers = {'accept':'application/json','Content-Type':'application/json'}
 default_filter = '!ipv6 && (ssdp || (http && http.user_agent != "") || xml || sip || browser || (mdns && (dns.resp.type == 1 || dns.resp.type == 16)))'
+## With the native decoder, mDNS / SSDP / NetBIOS browser packets are decoded in-process and tshark only handles the rest
+tshark_filter = '!ipv6 && ((http && http.user_agent != "") || xml || sip)'
 capture_running = False
 capture_count = 0
 skipped_packet = 0
@@ -53,6 +59,7 @@ def is_valid_IP(address):
 
 ## Pull up the cache of local endpoints and then send updates to ISE
 def update_ise_endpoints(local_redis, remote_redis):
+    results = []
     try:
         logger.info(f'gather active endpoints - Start')
         start_time = time.time()
@@ -62,24 +69,11 @@ def update_ise_endpoints(local_redis, remote_redis):
         if results:
             endpoint_updates = []
             endpoint_creates = []
+            ## Check every pending entry against the remote_redis DB in one batch before sending API calls to ISE
+            changed_macs = redis_eps.check_remote_cache_batch(remote_redis, results)
             for row in results:
-                ## TODO - remove references to id, id_weight in endpointsdb
-                ## Does not include row[3] for "id", nor row[11] for "id_weight"
-                attributes = {
-                        "isepyHostname": row['name'].replace("’","'"),
-                        "isepyVendor": row['vendor'],
-                        "isepyModel": row['hw'],
-                        "isepyOS": row['sw'],
-                        "isepyDeviceID": row['productID'],
-                        "isepySerial": row['serial'],
-                        "isepyType": row['device_type'],
-                        "isepyProtocols": row['protocols'],
-                        "isepyIP": row['ip'],
-                        "isepyCertainty" : str(row['name_weight'])+","+str(row['vendor_weight'])+","+str(row['hw_weight'])+","+str(row['sw_weight'])+","+str(row['productID_weight'])+","+str(row['serial_weight'])+","+str(row['device_type_weight'])
-                        }
-                
-                ## For every entry, check if remote_redis DB has record before sending API call to ISE
-                status = redis_eps.check_remote_cache(remote_redis,row['mac'],attributes)
+                attributes = redis_eps.ise_attributes(row)
+                status = row['mac'] not in changed_macs
                 ## If the value does not exist in remote redis cache, check returned API information against captured values
                 if status == False:
                     ise_custom_attrib = ise_apis.get_ise_endpoint(row['mac'])
@@ -166,6 +160,8 @@ def update_ise_endpoints(local_redis, remote_redis):
         raise
     except Exception as e:
         logging.warning(f'an error occured during routine check: {e}')
+        ## Return this cycle's endpoints to the dirty set so the next cycle retries them
+        redis_eps.mark_dirty(local_redis, [row['mac'] for row in results])
 
 ### Process network packets using global Parser instance and dictionary of supported protocols
 def process_packet(packet, highest_layer):
@@ -177,22 +173,32 @@ def process_packet(packet, highest_layer):
             if inspection_layer == 'XML':
                 fn = parser.parse_xml(packet)
                 if fn is not None:
-                    redis_eps.add_or_update_entry(local_db,fn)
+                    local_buffer.add(fn)
             else:
                 for layer in packet.layers:
                     fn = packet_callbacks.get(layer.layer_name)
                     if fn is not None:
-                        redis_eps.add_or_update_entry(local_db,fn(packet))
+                        local_buffer.add(fn(packet))
     except Exception as e:
         logger.debug(f'error processing packet details {highest_layer}: {e}')
 
 ## Process a given PCAP(NG) file with a provided PCAP filter
-def process_capture_file(capture_file, capture_filter):
+def process_capture_file(capture_file, capture_filter, ingest='pyshark', native=False):
     if Path(capture_file).exists():
-        logger.info(f'processing capture file: {capture_file}')
+        logger.info(f'processing capture file: {capture_file} ({ingest} ingest' + (', native decoder)' if native else ')'))
         start_time = time.perf_counter()
-        capture = pyshark.FileCapture(capture_file, display_filter=capture_filter, only_summaries=False, include_raw=True, use_json=True)
         currentPacket = 0
+        if native:
+            ## Same mDNS record types as the default display filter
+            native_capture = rawcapture(input_file=capture_file, mdns_types=('1', '16'))
+            for packet in native_capture:
+                process_packet(packet, packet.highest_layer)
+                currentPacket += 1
+            logger.debug(f'native decoder stats: {native_capture.stats()}')
+        if ingest == 'fields':
+            capture = fieldcapture(input_file=capture_file, display_filter=capture_filter)
+        else:
+            capture = pyshark.FileCapture(capture_file, display_filter=capture_filter, only_summaries=False, include_raw=True, use_json=True)
         for packet in capture:
             ## Wrap individual packet processing within 'try' statement to avoid formatting issues crashing entire process
             try:
@@ -202,12 +208,18 @@ def process_capture_file(capture_file, capture_filter):
             currentPacket += 1
         capture.close()
         end_time = time.perf_counter()
-        logger.info(f'processing capture file complete: execution time: {end_time - start_time:0.6f} : {currentPacket} packets processed ##')
+        logger.info(f'processing capture file complete: execution time: {end_time - start_time:0.6f} : {currentPacket} packets processed '
+                    f'({currentPacket / (end_time - start_time):0.1f} packets/sec) ##')
     else:
         logger.warning(f'capture file not found: {capture_file}')
         sys.exit(0)
 
 if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Parse a local capture file and optionally send the endpoint data to ISE.')
+    argparser.add_argument('--ingest', required=False, choices=['pyshark', 'fields'], default='pyshark', help="Packet ingest engine: full pyshark JSON dissection, or 'fields' to have tshark emit only the fields the parsers use")
+    argparser.add_argument('--native-decoder', required=False, action='store_true', help='Decode mDNS, SSDP and NetBIOS browser packets in-process instead of with tshark')
+    args = argparser.parse_args()
+
     handler = logging.StreamHandler()
     handler.setFormatter(logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:%(message)s'))
     logger.addHandler(handler)
@@ -236,11 +248,15 @@ if __name__ == '__main__':
     local_db.flushdb()
     remote_db.flushdb()
     logger.debug(f'redis DB creation - Completed')
+    ## Coalesce repeated observations per MAC in memory before merging them into the local redis DB
+    local_buffer = coalescer(redis_eps, local_db)
     
     # ### PCAP PARSING SECTION
     start_time = time.time()
-    process_capture_file(filename, default_filter)
+    process_capture_file(filename, tshark_filter if args.native_decoder else default_filter, args.ingest, args.native_decoder)
+    local_buffer.close()
     end_time = time.time()
+    logger.debug(f'user-agent cache stats: {parser.ua_cache.stats()}')
     redis_eps.print_endpoints(local_db)
     print('#######################################')
     print('##  Capture File Analysis Complete')
@@ -267,6 +283,7 @@ if __name__ == '__main__':
     end_time = time.time()
     logger.warning(f'existing ISE attribute verification - Completed: {round(end_time - start_time,4)}sec')
     update_ise_endpoints(local_db, remote_db)
+    ise_apis.close()
     local_db.flushdb()
     remote_db.flushdb()
     logger.info(f'redis DB cache cleared')
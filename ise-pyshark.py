@@ -1,4 +1,5 @@
 import time
+import math
 import pyshark
 import redis
 import asyncio
@@ -8,15 +9,74 @@ import sys
 import os
 import psutil
 import logging
-from signal import SIGINT, SIGTERM
+import queue
+import threading
+import multiprocessing
+from signal import signal, SIGINT, SIGTERM, SIG_IGN
 from ise_pyshark import parser
+from ise_pyshark import unknownmodels
 from ise_pyshark import apis
+from ise_pyshark import isemirror
+from ise_pyshark import outbox
+from ise_pyshark import batcher
+from ise_pyshark import capturestats
+from ise_pyshark import fieldcapture
+from ise_pyshark import rawcapture
 from ise_pyshark import eps
+from ise_pyshark import coalescer
 
 logger = logging.getLogger(__name__)
 headers = {'accept':'application/json','Content-Type':'application/json'}
 default_bpf_filter = "(ip proto 0x2f || tcp port 80 || tcp port 8080 || udp port 1900 || udp port 138 || udp port 5060 || udp port 5353) and not ip6"
+## ERSPAN layouts the native decoder accepts (see rawcapture._erspan), as (BPF test, offset of the mirrored Ethernet frame)
+## for an outer IPv4 header without options. Offsets are the ones the kernel filter sees: an outer VLAN tag is either
+## stripped before filtering (VLAN offload) or keeps the frame from matching 'ip proto 0x2f' at all.
+erspan_layouts = [
+    ('ip[0] & 0xf = 5 and ip[20:4] = 0x000088be', 38),                      ## type I
+    ('ip[0] & 0xf = 5 and ip[20:4] = 0x100088be', 50),                      ## type II (GRE sequence number)
+    ('ip[0] & 0xf = 5 and ip[20:4] = 0x100022eb and ip[39] & 1 = 0', 54),   ## type III
+    ('ip[0] & 0xf = 5 and ip[20:4] = 0x100022eb and ip[39] & 1 = 1', 62),   ## type III with platform sub-header
+]
+## (IP protocol, ports) handled by each capture path when the native decoder is on
+native_ports = [(17, (1900, 138, 5353))]
+tshark_ports = [(6, (80, 8080)), (17, (5060,))]
+
+## BPF test for a mirrored Ethernet frame at 'offset' (untagged or 802.1Q tagged) carrying IPv4 'proto' from or to one of 'ports'
+def mirrored_ports_filter(offset, proto, ports):
+    tests = []
+    for tag in (0, 4):
+        ip_offset = offset + 14 + tag
+        l4 = f'{ip_offset} + (ether[{ip_offset}] & 0xf) * 4'
+        port_tests = ' or '.join(f'ether[{l4} : 2] = {port} or ether[{l4} + 2 : 2] = {port}' for port in ports)
+        vlan = f'ether[{offset + 12}:2] = 0x8100 and ' if tag else ''
+        tests.append(f'({vlan}ether[{offset + 12 + tag}:2] = 0x0800 and ether[{ip_offset + 9}] = {proto} and ({port_tests}))')
+    return ' or '.join(tests)
+
+## ERSPAN traffic for one capture path, chosen by the mirrored frame's ports; 'unknown' adds GRE in any other layout
+def erspan_filter(protocol_ports, unknown=False):
+    tests = []
+    for test, offset in erspan_layouts:
+        mirrored = ' or '.join(mirrored_ports_filter(offset, proto, ports) for proto, ports in protocol_ports)
+        tests.append(f'({test} and ({mirrored}))')
+    if unknown:
+        tests.append('not (' + ' or '.join(f'({test})' for test, offset in erspan_layouts) + ')')
+    return f'(ip proto 0x2f and ({" or ".join(tests)}))'
+
+## With the native decoder, mDNS / SSDP / NetBIOS browser traffic, mirrored or not, is decoded in-process and tshark only
+## sees the rest: each ERSPAN frame goes to one path by its inner ports, and GRE the decoder cannot read goes to tshark
+native_bpf_filter = f"(udp port 1900 || udp port 138 || udp port 5353 || {erspan_filter(native_ports)}) and not ip6"
+tshark_bpf_filter = f"(tcp port 80 || tcp port 8080 || udp port 5060 || {erspan_filter(tshark_ports, unknown=True)}) and not ip6"
+native_layers = ['MDNS_RAW', 'SSDP_RAW', 'BROWSER_RAW']
+native_decoder = False
 capture_running = False
+## Bounded hand-off between the capture thread and the packet processing thread (see capture_worker / packet_worker)
+packet_queue = None
+capture_stats = None
+native_stats = None
+## Running fieldcapture / rawcapture instances, closed on shutdown so their tshark / dumpcap processes do not outlive us
+active_captures = []
+## Threads running those captures, joined on shutdown so each has recorded its capture buffer drops before the stats are logged
+capture_threads = []
 
 parser = parser()
 packet_callbacks = {
@@ -49,37 +109,108 @@ def is_valid_IP(address):
     except ipaddress.AddressValueError:
         return False
 
+## Send one bulk API call under the adaptive timeout; the timeout covers the HTTP exchange and cancels it
+async def bulk_update_with_timeout(action, chunk):
+    exchange = ise_batcher.exchange()
+    if action == 'create':
+        request = ise_apis.bulk_update_post_async(chunk, exchange)
+    else:
+        request = ise_apis.bulk_update_put_async(chunk, exchange)
+    try:
+        return await ise_batcher.send(request, len(chunk), exchange)
+    except asyncio.TimeoutError:
+        logger.warning(f'API call to ISE for endpoint {action} timed out')
+
+## Fetch ISE custom attributes for 'macs' with at most --api-concurrency lookups in flight; returns {mac: result}
+## When the ISE endpoint mirror is enabled, only MACs it has no record of are requested individually
+async def lookup_ise_endpoints(macs):
+    results = {}
+    if ise_mirror is not None:
+        for mac in macs:
+            mirrored = ise_mirror.get(mac)
+            if mirrored is not isemirror.missing:
+                results[mac] = mirrored
+    limit = asyncio.Semaphore(args.api_concurrency)
+    async def lookup(mac):
+        async with limit:
+            return await ise_apis.get_ise_endpoint_async(mac)
+    misses = [mac for mac in macs if mac not in results]
+    lookups = await asyncio.gather(*[lookup(mac) for mac in misses])
+    results.update(zip(misses, lookups))
+    return results
+
+## Bulk chunks sent at once: as many as the write budget sustains at the typical bulk latency (at least its burst),
+## so further chunks wait here instead of queueing for write tokens until they are shed; None when writes are unlimited
+def outbox_concurrency():
+    bucket = ise_apis.write_bucket
+    if bucket.rate <= 0:
+        return None
+    return max(1, math.ceil(bucket.burst), math.ceil(bucket.rate * ise_batcher.percentile(50)))
+
+## Send every due outbox entry to ISE in concurrent bulk chunks
+async def send_ise_outbox(remote_redis):
+    pending = ise_outbox.due()
+    if not pending:
+        logger.debug(f'no endpoints created or updated in ISE')
+        return
+    ## Chunk size adapts to observed ISE bulk latency and errors (see batcher)
+    chunk_size = ise_batcher.size
+    concurrency = outbox_concurrency()
+    limit = asyncio.Semaphore(concurrency) if concurrency else None
+    async def send_chunk(action, entries):
+        if limit is None:
+            return await send_outbox_chunk(remote_redis, action, entries)
+        async with limit:
+            return await send_outbox_chunk(remote_redis, action, entries)
+    bulk_calls = []
+    for action, entries in pending.items():
+        logger.debug(f'{action} {len(entries)} endpoints in ISE - Start')
+        for i in range(0, len(entries),chunk_size):
+            bulk_calls.append(send_chunk(action, entries[i:i + chunk_size]))
+    acks = await asyncio.gather(*bulk_calls)
+    logger.debug(f'ISE bulk calls - {sum(acks)} of {len(acks)} chunks acknowledged ({concurrency or "unlimited"} in flight) - outbox: {ise_outbox.stats()}')
+    logger.info(f'ISE bulk stats: {ise_batcher.stats()}')
+    logger.info(f"ISE API breaker: {ise_apis.breaker.stats()}, read budget: {ise_apis.read_bucket.stats()}, write budget: {ise_apis.write_bucket.stats()}")
+
+## Send one chunk; once ISE acknowledges it, drop it from the outbox and commit the rows to the remote cache
+async def send_outbox_chunk(remote_redis, action, entries):
+    chunk = [entry['update'] for entry in entries]
+    if not await bulk_update_with_timeout(action, chunk):
+        ise_outbox.retry(entries)
+        return False
+    ise_outbox.ack(entries)
+    for entry in entries:
+        redis_eps.add_or_update_entry(remote_redis, entry['row'], True)
+    if ise_mirror is not None:
+        ise_mirror.apply(chunk)
+    return True
+
 async def update_ise_endpoints_async(local_redis, remote_redis):
+    results = []
     try:
         logger.info(f'gather active endpoints - Start')
         start_time = time.time()
+        if ise_mirror is not None:
+            ise_mirror.refresh()
         ## Gather a copy of all of the local_redis entries that have new information
         results = await redis_eps.updated_local_entries_async(local_redis)
         logger.debug(f'number of local || remote redis entries: {local_redis.dbsize()} || {remote_redis.dbsize()}')
         if results:
             endpoint_updates = []
             endpoint_creates = []
+            checked_rows = []
+            ## Check every pending entry against the remote_redis DB in one batch before sending API calls to ISE
+            changed_macs = await redis_eps.check_remote_cache_batch_async(remote_redis, results)
+            ## Look up the changed endpoints in ISE concurrently and join the results before building the bulk queues
+            lookup_start = time.time()
+            ise_lookups = await lookup_ise_endpoints([row['mac'] for row in results if row['mac'] in changed_macs])
+            logger.debug(f'ISE lookups for {len(ise_lookups)} endpoints - Completed {round(time.time() - lookup_start,4)}sec')
             for row in results:
-                ## TODO - remove references to id, id_weight in endpointsdb
-                ## Does not include row[3] for "id", nor row[11] for "id_weight"
-                attributes = {
-                        "isepyHostname": row['name'].replace("’","'"),
-                        "isepyVendor": row['vendor'],
-                        "isepyModel": row['hw'],
-                        "isepyOS": row['sw'],
-                        "isepyDeviceID": row['productID'],
-                        "isepySerial": row['serial'],
-                        "isepyType": row['device_type'],
-                        "isepyProtocols": row['protocols'],
-                        "isepyIP": row['ip'],
-                        "isepyCertainty" : str(row['name_weight'])+","+str(row['vendor_weight'])+","+str(row['hw_weight'])+","+str(row['sw_weight'])+","+str(row['productID_weight'])+","+str(row['serial_weight'])+","+str(row['device_type_weight'])
-                        }
-                
-                ## For every entry, check if remote_redis DB has record before sending API call to ISE
-                status = await redis_eps.check_remote_cache_async(remote_redis, row['mac'], attributes)
+                attributes = redis_eps.ise_attributes(row)
+                status = row['mac'] not in changed_macs
                 ## If the value does not exist in remote redis cache, check returned API information against captured values
                 if status == False:
-                    ise_custom_attrib = await ise_apis.get_ise_endpoint_async(row['mac'])
+                    ise_custom_attrib = ise_lookups[row['mac']]
                     if ise_custom_attrib == "no_values":
                         ## If endpoint exists, but custom attributes not populated, add to update queue
                         update = { "customAttributes": attributes, "mac": row['mac'] }
@@ -136,40 +267,29 @@ async def update_ise_endpoints_async(local_redis, remote_redis):
                         else:
                             logger.debug(f"no new data for endoint: {row['mac']}")
 
+                    checked_rows.append(row)
+            ## Endpoints queued for ISE go through the durable outbox and only reach the remote cache once ISE acknowledges them
+            rows = {row['mac']: row for row in checked_rows}
+            ise_outbox.put([('update', update, rows[update['mac']]) for update in endpoint_updates] +
+                           [('create', update, rows[update['mac']]) for update in endpoint_creates])
+            queued = {update['mac'] for update in endpoint_updates + endpoint_creates}
+            for row in checked_rows:
+                if row['mac'] not in queued:
                     redis_eps.add_or_update_entry(remote_redis,row, True)
-            logger.info(f'check for endpoint updates to ISE - Start')
-            if (len(endpoint_creates) + len(endpoint_updates)) == 0:
-                logger.debug(f'no endpoints created or updated in ISE')
-            if len(endpoint_updates) > 0:
-                logger.debug(f'creating, updating {len(endpoint_updates)} endpoints in ISE - Start')
-                chunk_size = 500
-                for i in range(0, len(endpoint_updates),chunk_size):
-                    chunk = endpoint_updates[i:i + chunk_size]
-                    ## TODO perform similar try/except blocks with timeouts for other API and async-based functions
-                    try:
-                        result = await asyncio.wait_for(ise_apis.bulk_update_put_async(chunk), timeout=3)
-                    except asyncio.TimeoutError:
-                        logger.warning('API call to ISE for endpoint update timed out')
-                logger.debug(f'updating {len(endpoint_updates)} endpoints in ISE - Completed')
-            if len(endpoint_creates) > 0:
-                logger.debug(f'creating {len(endpoint_creates)} new endpoints in ISE - Start')
-                chunk_size = 500
-                for i in range(0, len(endpoint_creates),chunk_size):
-                    chunk = endpoint_creates[i:i + chunk_size]
-                    try: 
-                        result = await asyncio.wait_for(ise_apis.bulk_update_post_async(chunk), timeout=3)
-                    except asyncio.TimeoutError:
-                        logger.warning('API call to ISE for endpoint creation timed out')
-                logger.debug(f'creating {len(endpoint_creates)} new endpoints in ISE - Completed')
-            end_time = time.time()
-            logger.debug(f'check for endpoint updates to ISE - Completed {round(end_time - start_time,4)}sec')
-        logger.info(f'gather active endpoints - Completed - {len(results)} records checked')
+        ## Send this cycle's updates along with any earlier ones now due for a retry
+        logger.info(f'check for endpoint updates to ISE - Start')
+        await send_ise_outbox(remote_redis)
+        end_time = time.time()
+        logger.debug(f'check for endpoint updates to ISE - Completed {round(end_time - start_time,4)}sec')
+        logger.info(f'gather active endpoints - Completed - {len(results)} records checked - cycle time {round(time.time() - start_time,4)}sec')
     except asyncio.CancelledError as e:
         logging.warning('routine check task cancelled')
         logging.warning(f'asyncio error - {e}')
         raise
     except Exception as e:
         logging.warning(f'an error occured during routine check: {e}')
+        ## Return this cycle's endpoints to the dirty set so the next cycle retries them
+        redis_eps.mark_dirty(local_redis, [row['mac'] for row in results])
 
 ## Return a list of processes matching 'name' (https://psutil.readthedocs.io/en/latest/)
 def find_procs_by_name(name):
@@ -220,37 +340,175 @@ def process_packet(packet, highest_layer):
             if inspection_layer == 'XML':
                 fn = parser.parse_xml(packet)
                 if fn is not None:
-                    redis_eps.add_or_update_entry(local_db,fn)
+                    local_buffer.add(fn)
             else:
                 for layer in packet.layers:
                     fn = packet_callbacks.get(layer.layer_name)
                     if fn is not None:
-                        redis_eps.add_or_update_entry(local_db,fn(packet))
+                        local_buffer.add(fn(packet))
     except Exception as e:
         logger.debug(f'error processing packet details {highest_layer}: {e}')
 
-def capture_live_packets(network_interface, bpf_filter):
+## tshark options for the optional capture file: a ring buffer of 'ring_files' files of 'ring_filesize' KB each, or one unbounded file.
+## Packets stay decoded while tshark writes the file the same way in both cases: pyshark's include_raw '-x' and
+## fieldcapture's own '-P' both tell tshark to print packets even when '-w' is given, so no '-P' is added here.
+def capture_file_parameters(ring_filesize, ring_files):
+    if not ring_filesize:
+        return []
+    return ['-b', f'filesize:{ring_filesize}', '-b', f'files:{ring_files}']
+
+## One long-lived tshark instance per capture: it only returns on shutdown or when tshark / dumpcap fails
+def capture_live_packets(network_interface, bpf_filter, output_file=None, ring_filesize=0, ring_files=0, ingest='pyshark'):
     currentPacket = 0
     skipped_packet = 0
-    capture = pyshark.LiveCapture(interface=network_interface, bpf_filter=bpf_filter, include_raw=True, use_json=True, output_file='/tmp/pyshark.pcapng')
-    logger.debug(f'beginning capture instance to file: {capture._output_file}')
-    for packet in capture.sniff_continuously(packet_count=200000):
+    custom_parameters = capture_file_parameters(ring_filesize, ring_files) if output_file else None
+    stats = capture_stats
+    if ingest == 'native':
+        ## dumpcap feeds raw frames to the in-process decoder; the capture file, if any, is written by the tshark capture
+        capture = rawcapture(interface=network_interface, bpf_filter=bpf_filter)
+        stats = native_stats
+    elif ingest == 'fields':
+        ## tshark emits only the fields the parser callbacks read, wrapped in pyshark-compatible packet objects
+        capture = fieldcapture(interface=network_interface, bpf_filter=bpf_filter, output_file=output_file, custom_parameters=custom_parameters)
+    else:
+        capture = pyshark.LiveCapture(interface=network_interface, bpf_filter=bpf_filter, include_raw=True, use_json=True, output_file=output_file,
+                                      custom_parameters=custom_parameters)
+    if output_file and ingest != 'native':
+        logger.debug(f'beginning capture instance to file: {output_file}' + (f' (ring buffer of {ring_files} x {ring_filesize}KB)' if ring_filesize else ''))
+    else:
+        logger.debug(f'beginning {ingest} capture instance')
+    stats.start()
+    if ingest != 'pyshark':
+        active_captures.append(capture)
+    try:
+        for packet in capture.sniff_continuously():
+            if not capture_running:
+                break
+            stats.packet()
+            try:
+                highest_layer = packet.highest_layer
+                if native_decoder and ingest != 'native' and highest_layer in native_layers:
+                    skipped_packet += 1
+                elif highest_layer not in ['DATA_RAW', 'TCP_RAW', 'UDP_RAW', 'JSON_RAW', 'DATA-TEXT-LINES_RAW', 'IMAGE-GIF_RAW', 'IMAGE-JFIF_RAW', 'PNG-RAW']:
+                    ## Never block the capture on a slow consumer; count what the queue could not take instead
+                    try:
+                        packet_queue.put_nowait((packet, highest_layer))
+                    except queue.Full:
+                        stats.queue_drop()
+                else:
+                    skipped_packet += 1
+                currentPacket += 1
+            except Exception as e:
+                logger.debug(f'error processing packet {e}')
+                logger.warning(f'error processing packet {e}')
+    finally:
+        logger.debug(f'captured packets = {currentPacket}, skipped packets = {skipped_packet}, capture stats = {stats.stats()}')
+        if capture in active_captures:
+            active_captures.remove(capture)
+        capture.close()
+        ## fieldcapture / rawcapture read tshark's / dumpcap's exit summary on close; pyshark's LiveCapture does not expose it
+        stats.buffer_drop(getattr(capture, 'drops', None))
+        logger.debug(f'stopping capture instance')
+
+## Capture thread: keep one capture running until shutdown, starting a new one only if it fails; pyshark needs an event loop of its own in this thread
+def capture_worker(network_interface, bpf_filter, output_file=None, ring_filesize=0, ring_files=0, ingest='pyshark'):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    while capture_running:
         try:
-            highest_layer = packet.highest_layer
-            if highest_layer not in ['DATA_RAW', 'TCP_RAW', 'UDP_RAW', 'JSON_RAW', 'DATA-TEXT-LINES_RAW', 'IMAGE-GIF_RAW', 'IMAGE-JFIF_RAW', 'PNG-RAW']:
-                process_packet(packet, highest_layer)
-            else:
-                skipped_packet += 1
-            currentPacket += 1
+            capture_live_packets(network_interface, bpf_filter, output_file, ring_filesize, ring_files, ingest)
         except Exception as e:
-            logger.debug(f'error processing packet {e}')
-            logger.warning(f'error processing packet {e}')
-    logger.debug(f'captured packets = {currentPacket}, skipped packets = {skipped_packet}')
-    capture.close()
-    logger.debug(f'stopping capture instance')
-    ## Check for any orphaned 'dumpcap' processes from pyshark still running from old instance, and terminate them
-    time.sleep(1)
-    # proc_cleanup('dumpcap')
+            logger.warning(f'error with catpure instance {e}')
+        ## A capture only ends on its own when tshark / dumpcap exits; back off briefly so a persistent failure does not spin
+        if capture_running:
+            time.sleep(1)
+
+## Packet processing thread: parse queued packets into the coalescing buffer until the None sentinel arrives
+def packet_worker():
+    while True:
+        item = packet_queue.get()
+        if item is None:
+            break
+        process_packet(*item)
+
+## Restrict a BPF filter to the share of source MACs handled by one of 'workers' capture processes (last MAC octet modulo
+## the worker count), so every observation of an endpoint is parsed and merged, in order, by the same process. ERSPAN
+## traffic is split on the mirrored frame's source MAC at its offset for each ERSPAN layout (the inner MAC addresses
+## precede any 802.1Q tag); GRE in any other layout cannot be split and goes to worker 0.
+def worker_bpf_filter(bpf_filter, worker, workers):
+    if workers <= 1:
+        return bpf_filter
+    tests = [f'({test} and ether[{offset + 11}] % {workers} = {worker})' for test, offset in erspan_layouts]
+    if worker == 0:
+        tests.append('not (' + ' or '.join(f'({test})' for test, offset in erspan_layouts) + ')')
+    return (f'({bpf_filter}) and ((ip proto 0x2f and ({" or ".join(tests)})) or '
+            f'(not ip proto 0x2f and ether[11] % {workers} = {worker}))')
+
+## Start the packet processing thread and the capture thread(s) feeding it; returns the processing thread
+def start_capture(interface, args, worker=0, workers=1):
+    global capture_running, packet_queue, capture_stats, native_stats, native_decoder
+    capture_running = True
+    packet_queue = queue.Queue(maxsize=args.packet_queue_size)
+    ## Interface drop counters cover the whole interface: sample them in one capture only
+    capture_stats = capturestats(interface, args.startup_window, sample_interface=worker == 0)
+    native_decoder = args.native_decoder
+    capture_file = args.capture_file
+    if capture_file and workers > 1:
+        root, ext = os.path.splitext(capture_file)
+        capture_file = f'{root}-{worker}{ext}'
+    bpf_filter = worker_bpf_filter(tshark_bpf_filter if native_decoder else default_bpf_filter, worker, workers)
+    process_thread = threading.Thread(target=packet_worker, name='packet-processing', daemon=True)
+    process_thread.start()
+    capture_thread = threading.Thread(target=capture_worker, args=(interface, bpf_filter, capture_file, args.ring_filesize, args.ring_files, args.ingest),
+                                      name='capture', daemon=True)
+    capture_thread.start()
+    ## A pyshark capture only stops on its next packet, so shutdown does not wait for it
+    if args.ingest != 'pyshark':
+        capture_threads.append(capture_thread)
+    if native_decoder:
+        native_stats = capturestats(interface, args.startup_window, sample_interface=False)
+        native_thread = threading.Thread(target=capture_worker, args=(interface, worker_bpf_filter(native_bpf_filter, worker, workers)), kwargs={'ingest': 'native'},
+                                         name='native-capture', daemon=True)
+        native_thread.start()
+        capture_threads.append(native_thread)
+    return process_thread
+
+## Stop capturing, parse the packets already queued and flush the coalescing buffer
+def stop_capture(process_thread):
+    global capture_running
+    capture_running = False
+    ## Ending the tshark / dumpcap subprocesses unblocks their capture threads; pyshark captures stop on their next packet
+    for capture in list(active_captures):
+        capture.close()
+    for thread in capture_threads:
+        thread.join(timeout=5)
+    packet_queue.put(None)
+    process_thread.join()
+    local_buffer.close()
+    ## Worker processes exit through os._exit, which skips atexit handlers, so write out the last unknown models here
+    parser.unknown_models.close()
+    logger.debug(f'capture stats: {capture_stats.stats()}')
+    if native_stats is not None:
+        logger.debug(f'native decoder capture stats: {native_stats.stats()}')
+
+## Capture worker process (--workers): captures and parses its share of source MACs into the shared local redis DB
+## while the parent process runs the ISE sync loop and coordinates shutdown through 'stop_event'
+def capture_process(worker, workers, interface, args, stop_event):
+    global local_buffer
+    parent = os.getppid()
+    ## Ctrl-C reaches the whole process group; only the parent acts on it. SIGTERM stops the workers directly.
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, lambda signum, frame: stop_event.set())
+    local_buffer = coalescer(redis_eps, local_db, args.flush_interval, args.flush_size)
+    ## Each worker keeps its own unknown models file; a shared one would be rewritten by every worker in turn
+    root, ext = os.path.splitext(parser.unknown_models.file)
+    parser.unknown_models = unknownmodels(f'{root}-{worker}{ext}')
+    process_thread = start_capture(interface, args, worker, workers)
+    logger.debug(f'capture worker {worker + 1}/{workers} started (pid {os.getpid()})')
+    ## Also stop if the parent went away without signalling
+    while not stop_event.wait(1.0) and os.getppid() == parent:
+        pass
+    stop_capture(process_thread)
+    logger.debug(f'capture worker {worker + 1}/{workers} stopped, user-agent cache stats: {parser.ua_cache.stats()}')
 
 async def default_update_loop():
     try:
@@ -258,6 +516,8 @@ async def default_update_loop():
             ## Every five minutes perform an update to ISE of any new information
             await asyncio.sleep(5.0)
             await update_ise_endpoints_async(local_db, remote_db)
+            if packet_queue is not None:
+                logger.debug(f'packet queue depth: {packet_queue.qsize()}, capture stats: {capture_stats.stats()}')
     except asyncio.CancelledError as e:
         pass
     logger.debug(f'shutting down loop instance')
@@ -267,9 +527,37 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description="Provide ISE URL and API credentials.")
     argparser.add_argument('-u', '--username', required=True, help='ISE API username')
     argparser.add_argument('-p', '--password', required=True, help='ISE API password')
-    argparser.add_argument('-a', '--ip', required=True, help='ISE URL')
+    argparser.add_argument('-a', '--ip', required=True, help='ISE URL (comma-separated list for multiple ISE nodes)')
     argparser.add_argument('-i', '--interface', required=True, help='Network interface to monitor traffic')
     argparser.add_argument('-D', '--debug',  required=False, action='store_true', help='Enable debug logging')
+    argparser.add_argument('--flush-interval', required=False, type=float, default=1.0, help='Seconds between flushes of coalesced endpoint data to redis (0 writes every observation immediately)')
+    argparser.add_argument('--flush-size', required=False, type=int, default=500, help='Flush coalesced endpoint data once this many endpoints are buffered')
+    argparser.add_argument('--packet-queue-size', required=False, type=int, default=10000, help='Captured packets buffered for processing before new packets are dropped')
+    argparser.add_argument('--api-pool-size', required=False, type=int, default=10, help='Maximum number of persistent HTTPS connections kept open to ISE')
+    argparser.add_argument('--api-concurrency', required=False, type=int, default=20, help='Maximum number of ISE endpoint lookups in flight during a sync cycle')
+    argparser.add_argument('--api-node-limit', required=False, type=int, default=None, help='Maximum number of requests in flight to a single ISE node (default: --api-pool-size)')
+    argparser.add_argument('--ise-mirror', required=False, action='store_true', help='Mirror ISE endpoint custom attributes locally (paged bulk fetch) instead of one lookup per endpoint')
+    argparser.add_argument('--mirror-refresh', required=False, type=float, default=3600.0, help='Seconds between refreshes of the ISE endpoint mirror. Each refresh reloads every mirrored endpoint (there is no delta refresh), so changes made in ISE by other clients can go unseen for up to this long; lower it to bound that staleness at the cost of more paged API calls')
+    argparser.add_argument('--mirror-page-size', required=False, type=int, default=100, help='Endpoints requested per page when loading the ISE endpoint mirror')
+    argparser.add_argument('--mirror-filter', required=False, default=None, help='Optional ISE API filter expression limiting which endpoints are mirrored')
+    argparser.add_argument('--outbox-db', required=False, type=int, default=2, help='redis DB number holding ISE updates awaiting acknowledgement (kept across restarts)')
+    argparser.add_argument('--outbox-max-age', required=False, type=float, default=3600.0, help='Seconds an unacknowledged ISE update is retried before it is dropped')
+    argparser.add_argument('--bulk-min-size', required=False, type=int, default=25, help='Smallest number of endpoints sent in one ISE bulk request')
+    argparser.add_argument('--bulk-max-size', required=False, type=int, default=500, help='Largest number of endpoints sent in one ISE bulk request')
+    argparser.add_argument('--bulk-max-timeout', required=False, type=float, default=30.0, help='Upper bound in seconds for the adaptive ISE bulk request timeout')
+    argparser.add_argument('--api-health-interval', required=False, type=float, default=30.0, help='Seconds between health checks of each ISE node when several are given')
+    argparser.add_argument('--api-read-rate', required=False, type=float, default=0.0, help='Maximum ISE API read requests per second (0 for no limit; lookups are already bounded by --api-concurrency)')
+    argparser.add_argument('--api-write-rate', required=False, type=float, default=2.0, help='Maximum ISE API write requests per second (0 for no limit)')
+    argparser.add_argument('--api-failure-threshold', required=False, type=int, default=5, help='Consecutive failed ISE API calls before calls are paused')
+    argparser.add_argument('--api-reset-timeout', required=False, type=float, default=30.0, help='Seconds ISE API calls stay paused before a recovery probe')
+    argparser.add_argument('--ingest', required=False, choices=['pyshark', 'fields'], default='pyshark', help="Packet ingest engine: full pyshark JSON dissection, or 'fields' to have tshark emit only the fields the parsers use")
+    argparser.add_argument('--workers', required=False, type=int, default=1, help='Capture worker processes, each handling a share of endpoint MAC addresses (default 1: capture in this process)')
+    argparser.add_argument('--native-decoder', required=False, action='store_true', help='Decode mDNS, SSDP and NetBIOS browser packets in-process instead of with tshark')
+    argparser.add_argument('--capture-file', required=False, default=None, help='Also write captured packets to this pcapng file (default: no capture file)')
+    argparser.add_argument('--ring-filesize', required=False, type=int, default=0, help='Rotate the capture file after this many KB (0 for a single unbounded file)')
+    argparser.add_argument('--ring-files', required=False, type=int, default=10, help='Number of rotated capture files kept when --ring-filesize is set')
+    argparser.add_argument('--startup-window', required=False, type=float, default=10.0, help='Seconds after the capture starts whose packet drops are reported as start-up drops')
+    argparser.add_argument('--api-timeout', required=False, type=float, default=30.0, help='Seconds to wait for an ISE API response')
     args = argparser.parse_args()
 
     handler = logging.StreamHandler()
@@ -289,7 +577,8 @@ if __name__ == '__main__':
 
     username = args.username
     password = args.password
-    ip = args.ip
+    ## Several ISE nodes may be given as a comma-separated list
+    ips = [ip.strip() for ip in args.ip.split(',')]
     interface = args.interface
 
     ints = psutil.net_if_addrs().keys()
@@ -298,16 +587,19 @@ if __name__ == '__main__':
         logger.warning(f'Valid interface names are: {ints}')
         sys.exit(1)
     
-    if is_valid_IP(ip) == False:
+    if not all(is_valid_IP(ip) for ip in ips):
         logger.warning('Invalid IP address provided')
         sys.exit(1)
     else:
-        fqdn = 'https://'+ip
+        fqdn = ['https://'+ip for ip in ips]
 
     ## Validate that defined ISE instance has Custom Attributes defined
     logger.warning(f'checking ISE custom attributes - Start')
     start_time = time.time()
-    ise_apis = apis(fqdn, username, password, headers)
+    ise_apis = apis(fqdn, username, password, headers, pool_size=args.api_pool_size, timeout=(5.0, args.api_timeout), max_in_flight=args.api_node_limit,
+                    read_rate=args.api_read_rate, write_rate=args.api_write_rate, failure_threshold=args.api_failure_threshold, reset_timeout=args.api_reset_timeout)
+    if args.api_read_rate > 0:
+        logger.warning(f'ISE reads limited to {args.api_read_rate}/sec - endpoint lookups cannot go faster regardless of --api-concurrency {args.api_concurrency}')
     current_attribs = ise_apis.get_ise_attributes()
     ise_apis.validate_attributes(current_attribs, variables)
     end_time = time.time()
@@ -322,8 +614,39 @@ if __name__ == '__main__':
 
     local_db.flushdb()
     remote_db.flushdb()
+    ## ISE updates not yet acknowledged are kept in their own DB, which is not flushed, and resent after a restart
+    outbox_db = redis.Redis(host='localhost', port=6379, db=args.outbox_db)
+    ise_outbox = outbox(outbox_db, max_age=args.outbox_max_age)
+    ise_batcher = batcher(args.bulk_min_size, args.bulk_max_size, max_timeout=args.bulk_max_timeout)
     logger.warning(f'redis DB creation - Completed')
 
+    ## Fork capture worker processes before this process starts any threads of its own
+    capture_procs = []
+    stop_event = None
+    if args.workers > 1:
+        context = multiprocessing.get_context('fork')
+        stop_event = context.Event()
+        for worker in range(args.workers):
+            capture_procs.append(context.Process(target=capture_process, args=(worker, args.workers, interface, args, stop_event),
+                                                 name=f'capture-{worker}', daemon=True))
+            capture_procs[-1].start()
+        logger.warning(f'started {args.workers} capture worker processes')
+    else:
+        ## Coalesce repeated observations per MAC in memory before merging them into the local redis DB
+        local_buffer = coalescer(redis_eps, local_db, args.flush_interval, args.flush_size)
+
+    ## Optionally pre-load the ISE endpoint mirror so sync cycles only issue per-MAC GETs for endpoints it has not seen
+    ise_mirror = None
+    loop = asyncio.get_event_loop()
+    if args.ise_mirror:
+        logger.warning(f'ISE endpoint mirror load - Start')
+        ise_mirror = isemirror(ise_apis, args.mirror_page_size, args.mirror_refresh, args.mirror_filter)
+        loop.run_until_complete(ise_mirror.load())
+        logger.warning(f'ISE endpoint mirror load - Completed')
+
+    ## Probe every ISE node in the background so failed nodes leave, and recovered nodes rejoin, the rotation
+    ise_apis.start_health_checks(args.api_health_interval)
+
     ## Setup the publishing loop
     main_task = asyncio.ensure_future(
         default_update_loop()
@@ -334,28 +657,35 @@ if __name__ == '__main__':
         global capture_running
         main_task.cancel()
         capture_running = False
-    loop = asyncio.get_event_loop()
     loop.add_signal_handler(SIGINT, signal_handlers)
     loop.add_signal_handler(SIGTERM, signal_handlers)
 
     ## LIVE PCAP SECTION
-    capture_running = True
+    ## Capture and packet processing run in their own threads (or worker processes) so the ISE update loop keeps running on this one
+    process_thread = start_capture(interface, args) if not capture_procs else None
     try:
-        while capture_running:
-            try:
-                # capture_live_packets(args.interface, default_bpf_filter)
-                capture_live_packets(interface, default_bpf_filter)
-            except Exception as e:
-                logger.warning(f'error with catpure instance {e}')
+        loop.run_until_complete(main_task)
     except KeyboardInterrupt:
         logger.warning(f'closing capture down due to keyboard interrupt')
-        capture_running = False
-        sys.exit(0)
-    try:
-        loop.run_until_complete(main_task)
     except:
         pass
+    if process_thread is not None:
+        stop_capture(process_thread)
+    else:
+        ## Workers drain and flush their own buffers; give them time before forcing them down
+        stop_event.set()
+        for proc in capture_procs:
+            proc.join(timeout=30)
+            if proc.is_alive():
+                logger.warning(f'capture worker {proc.name} did not stop, killing it')
+                proc.kill()
     logger.warning(f'### LIVE PACKET CAPTURE STOPPED ###')
+    logger.debug(f'user-agent cache stats: {parser.ua_cache.stats()}')
+    logger.debug(f'ISE outbox stats: {ise_outbox.stats()}')
+    logger.debug(f'ISE bulk stats: {ise_batcher.stats()}')
+    if ise_mirror is not None:
+        logger.debug(f'ISE endpoint mirror stats: {ise_mirror.stats()}')
+    loop.run_until_complete(ise_apis.close_async())
 
     logger.debug(f'local entries: {local_db.dbsize()}, remote entries: {remote_db.dbsize()}')
     print(f'LOCAL ENTRIES')
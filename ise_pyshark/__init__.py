@@ -5,9 +5,21 @@ __version__ = _version.get_versions()['version']
 
 from .endpointsdb import endpointsdb
 from .ouidb import ouidb
+from .modelindex import modelindex
+from .uacache import uacache
+from .unknownmodels import unknownmodels
 from .parser import parser
+from .tokenbucket import tokenbucket
+from .circuitbreaker import circuitbreaker
 from .apis import apis
+from .isemirror import isemirror
+from .outbox import outbox
+from .batcher import batcher
+from .capturestats import capturestats
+from .fieldcapture import fieldcapture
+from .rawcapture import rawcapture
 from .eps import eps
+from .coalescer import coalescer
 
 logger = logging.getLogger(__name__)
 from . import _version
@@ -3,10 +3,19 @@ import sys
 import logging
 import requests
 import time
+import asyncio
+import functools
+import importlib.util
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urllib3.exceptions import InsecureRequestWarning
+from .tokenbucket import tokenbucket
+from .circuitbreaker import circuitbreaker
 # # Suppress only the single InsecureRequestWarning from urllib3 needed
 urllib3.disable_warnings(InsecureRequestWarning)
+## aiohttp is optional ('pip install ise_pyshark[async]'); without it the *_async methods run the pooled session on a worker thread.
+## It is only imported on the first async request: importing it costs more than the rest of the package's start-up.
+aiohttp_available = importlib.util.find_spec('aiohttp') is not None
 
 logger = logging.getLogger(__name__)
 
@@ -23,14 +32,271 @@ ise_attributes = {'isepyVendor':'String',
              'isepyCertainty':'String'
             }
 
+## Transport errors raised by either async client path (aiohttp errors are re-raised as requests ConnectionError);
+## asyncio.TimeoutError comes from the exchange timeout in _send_async whichever client is in use
+async_errors = (requests.exceptions.RequestException, asyncio.TimeoutError)
+
+## Default (connect, read) timeouts in seconds for ISE API calls
+default_timeout = (5.0, 30.0)
+
+## Raised (as a requests ConnectionError, so existing handlers apply) when a call is shed by the rate limit or circuit breaker
+class ise_unavailable(requests.exceptions.ConnectionError):
+    pass
+
+## Lightweight authenticated request used to probe node health
+health_check_path = '/api/v1/endpoint-custom-attribute'
+
 class apis:
-    def __init__(self, fqdn, user, pwd, headers):
-        ## TODO - check for multiple entries in FQDN field, and if multiple, include 'keep-alive' check for connectivity in case of failure
-        self.fqdn = fqdn
+    def __init__(self, fqdn, user, pwd, headers, pool_size=10, timeout=default_timeout, max_in_flight=None,
+                 read_rate=0, write_rate=0, max_wait=10.0, failure_threshold=5, reset_timeout=30.0):
+        ## 'fqdn' may list several ISE nodes (list or comma-separated); reads are spread across healthy nodes and
+        ## writes go to the first healthy node in the order given, failing over to the next one
+        self.nodes = [node.strip() for node in (fqdn.split(',') if isinstance(fqdn, str) else fqdn) if node.strip()]
+        self.fqdn = self.nodes[0]
+        self.healthy = {node: True for node in self.nodes}
+        self.read_index = 0
+        self.failovers = 0
+        self.health_task = None
         self.user = user
         self.pwd = pwd
         self.headers = headers
+        self.pool_size = pool_size
+        self.timeout = timeout
+        ## Cap on concurrent async requests per ISE node (defaults to the connection pool size)
+        self.max_in_flight = max_in_flight or pool_size
+        self.in_flight = {}
+        ## Requests-per-second budgets shared by every API method (0 = unlimited), and a breaker over all nodes
+        self.read_bucket = tokenbucket(read_rate)
+        self.write_bucket = tokenbucket(write_rate)
+        self.max_wait = max_wait
+        self.breaker = circuitbreaker(failure_threshold, reset_timeout)
+        self.request_count = 0
+        self.async_request_count = 0
+        self.session = self._new_session()
+        self.async_session = None
         # self._test_connection()
+
+    ## One keep-alive session per PAN: TLS connections are reused across calls instead of a handshake per request
+    def _new_session(self):
+        session = requests.Session()
+        session.auth = HTTPBasicAuth(self.user, self.pwd)
+        session.headers.update(self.headers)
+        session.verify = False
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    ## Order in which nodes are tried: reads rotate across healthy nodes, writes keep the configured order;
+    ## unhealthy nodes are only tried once every healthy node has failed
+    def _candidate_nodes(self, read):
+        healthy = [node for node in self.nodes if self.healthy[node]]
+        if read and len(healthy) > 1:
+            self.read_index = (self.read_index + 1) % len(healthy)
+            healthy = healthy[self.read_index:] + healthy[:self.read_index]
+        return healthy + [node for node in self.nodes if not self.healthy[node]]
+
+    def _mark(self, node, healthy):
+        if self.healthy[node] != healthy:
+            self.healthy[node] = healthy
+            if healthy:
+                logger.warning(f'ISE node {node} is available again')
+            else:
+                logger.warning(f'ISE node {node} marked unavailable')
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.request_count += 1
+        return self.session.request(method, url, **kwargs)
+
+    ## Take a token from the read or write budget; returns the seconds to wait, raises ise_unavailable if shed
+    def _reserve(self, method):
+        bucket = self.read_bucket if method == 'GET' else self.write_bucket
+        delay = bucket.reserve(self.max_wait)
+        if delay is None:
+            raise ise_unavailable(f'ISE API {method} request budget exhausted - request shed')
+        return delay
+
+    def _admit(self):
+        if not self.breaker.allow():
+            raise ise_unavailable('ISE API circuit breaker open - request shed')
+
+    ## Throttling and server errors count towards opening the breaker, as do requests no node answered
+    def _record(self, status_code):
+        if status_code == 429 or status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def _request(self, method, path, **kwargs):
+        delay = self._reserve(method)
+        if delay:
+            time.sleep(delay)
+        self._admit()
+        try:
+            response = self._request_nodes(method, path, **kwargs)
+        except BaseException:
+            ## Any error settles the breaker, so a half-open probe is never left outstanding
+            self.breaker.record_failure()
+            raise
+        self._record(response.status_code)
+        return response
+
+    ## Send 'path' to the first node that answers; connection errors and 5xx responses fail over to the next node
+    def _request_nodes(self, method, path, **kwargs):
+        nodes = self._candidate_nodes(method == 'GET')
+        for i, node in enumerate(nodes):
+            last = i == len(nodes) - 1
+            try:
+                response = self._send(method, node + path, **kwargs)
+            except requests.exceptions.RequestException:
+                self._mark(node, False)
+                if last:
+                    raise
+                self.failovers += 1
+                continue
+            if response.status_code >= 500 and not last:
+                self._mark(node, False)
+                self.failovers += 1
+                continue
+            if response.status_code < 500:
+                self._mark(node, True)
+            return response
+
+    ## aiohttp sessions belong to the running event loop, so create it on first use from within the loop
+    def _new_async_session(self):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.pool_size * len(self.nodes), limit_per_host=self.pool_size, ssl=False)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        return aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=timeout,
+                                     auth=aiohttp.BasicAuth(self.user, self.pwd))
+
+    ## Non-blocking request returning (status code, decoded JSON body), with the same node failover as _request;
+    ## cancelling the awaiting task aborts the request
+    ## NOTE: without aiohttp a cancelled call stops being awaited, but the worker thread finishes the HTTP round trip
+    ## 'exchange' (optional dict) bounds and times each HTTP exchange only (see _send_async), never the token wait
+    async def _request_async(self, method, path, exchange=None, **kwargs):
+        delay = self._reserve(method)
+        if delay:
+            await asyncio.sleep(delay)
+        self._admit()
+        try:
+            status_code, result = await self._request_nodes_async(method, path, exchange, **kwargs)
+        except BaseException:
+            ## Any error, or cancellation by the caller's timeout, settles the breaker, so a half-open probe is never
+            ## left outstanding
+            self.breaker.record_failure()
+            raise
+        self._record(status_code)
+        return status_code, result
+
+    async def _request_nodes_async(self, method, path, exchange=None, **kwargs):
+        nodes = self._candidate_nodes(method == 'GET')
+        for i, node in enumerate(nodes):
+            last = i == len(nodes) - 1
+            try:
+                async with self._node_slot(node):
+                    status_code, result = await self._send_async(method, node + path, exchange, **kwargs)
+            except async_errors:
+                self._mark(node, False)
+                if last:
+                    raise
+                self.failovers += 1
+                continue
+            if status_code >= 500 and not last:
+                self._mark(node, False)
+                self.failovers += 1
+                continue
+            if status_code < 500:
+                self._mark(node, True)
+            return status_code, result
+
+    ## Per-node semaphore bounding in-flight async requests, created on first use inside the running event loop
+    def _node_slot(self, node):
+        slot = self.in_flight.get(node)
+        if slot is None:
+            slot = self.in_flight[node] = asyncio.Semaphore(self.max_in_flight)
+        return slot
+
+    ## With an 'exchange' dict, the HTTP round trip alone (node slot and rate-limit token already held) runs under
+    ## exchange['timeout'] and reports its duration in exchange['elapsed'] and whether it timed out in exchange['timed_out']
+    async def _send_async(self, method, url, exchange=None, **kwargs):
+        if exchange is None:
+            return await self._exchange_async(method, url, **kwargs)
+        exchange['timed_out'] = False
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._exchange_async(method, url, **kwargs), exchange.get('timeout'))
+        except asyncio.TimeoutError:
+            exchange['timed_out'] = True
+            raise
+        finally:
+            exchange['elapsed'] = time.perf_counter() - start
+
+    async def _exchange_async(self, method, url, **kwargs):
+        if not aiohttp_available:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, functools.partial(self._send, method, url, **kwargs))
+            return response.status_code, response.json() if response.content else None
+        if self.async_session is None or self.async_session.closed:
+            self.async_session = self._new_async_session()
+        import aiohttp
+        self.async_request_count += 1
+        try:
+            async with self.async_session.request(method, url, **kwargs) as response:
+                try:
+                    return response.status, await response.json(content_type=None)
+                except ValueError as err:
+                    ## An HTML or truncated error page: raise a RequestException, as requests' response.json() does on the sync path
+                    raise requests.exceptions.InvalidJSONError(f'invalid JSON in HTTP {response.status} response from {url} - {err}')
+        except aiohttp.ClientError as err:
+            raise requests.exceptions.ConnectionError(f'{type(err).__name__} from {url} - {err}') from err
+
+    ## Probe one node; any authenticated 200 response puts it back into rotation
+    async def check_node_async(self, node):
+        try:
+            status_code, result = await self._send_async('GET', node + health_check_path)
+            self._mark(node, status_code == 200)
+        except async_errors as err:
+            logger.debug(f'ISE node {node} health check failed - {err}')
+            self._mark(node, False)
+
+    async def _health_check_loop(self, interval):
+        while True:
+            await asyncio.gather(*[self.check_node_async(node) for node in self.nodes])
+            await asyncio.sleep(interval)
+
+    ## Start background health checks of every node (only useful with more than one node); call from the running loop
+    def start_health_checks(self, interval=30.0):
+        if len(self.nodes) > 1 and self.health_task is None:
+            self.health_task = asyncio.ensure_future(self._health_check_loop(interval))
+
+    ## Connection reuse across the session: every request beyond a newly opened connection rode an existing one
+    def stats(self):
+        connections = 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+        reused = max(self.request_count - connections, 0)
+        ratio = round(reused / self.request_count, 3) if self.request_count else 0
+        return {'requests': self.request_count, 'connections': connections, 'reused': reused, 'reuse_ratio': ratio,
+                'async_requests': self.async_request_count, 'failovers': self.failovers,
+                'healthy_nodes': [node for node in self.nodes if self.healthy[node]], 'breaker': self.breaker.stats(),
+                'read_budget': self.read_bucket.stats(), 'write_budget': self.write_bucket.stats()}
+
+    def close(self):
+        logger.debug(f'ISE API session stats: {self.stats()}')
+        self.session.close()
+
+    async def close_async(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        if self.async_session is not None and not self.async_session.closed:
+            await self.async_session.close()
+        self.close()
     
     # def _test_connection(self):
     #     logger.debug(f'testing API creds to {self.fqdn}')
@@ -38,7 +304,7 @@ class apis:
     def get_ise_attributes(self):
         url_suffix = "/api/v1/endpoint-custom-attribute"
         try:
-            response = requests.get(self.fqdn + url_suffix, headers=self.headers, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            response = self._request('GET', url_suffix)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -76,10 +342,10 @@ class apis:
                 logger.debug(f"Skipping Custom Attribute '{attribute_name}' as it is not required for this program.")
 
     def create_ise_attribute(self, name, type):
-        url = f'{self.fqdn}/api/v1/endpoint-custom-attribute'
+        url_suffix = '/api/v1/endpoint-custom-attribute'
         data = {"attributeName": name,"attributeType": type}
         try:
-            response = requests.post(url, headers=self.headers, json=data, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            response = self._request('POST', url_suffix, json=data)
             if response.status_code == 200 or response.status_code == 201:
                 logger.debug(f'api response = {response.json()}')
         except requests.exceptions.RequestException as err:
@@ -88,10 +354,10 @@ class apis:
             sys.exit(0)
 
     def get_ise_endpoint(self, mac):
-        url = f'{self.fqdn}/api/v1/endpoint/{mac}'
+        url_suffix = f'/api/v1/endpoint/{mac}'
         try:
             start_get = time.time()
-            response = requests.get(url, headers=self.headers, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            response = self._request('GET', url_suffix)
             end_get = time.time()
             logger.debug(f'requesting ISE data for {mac} - ISE response time: {round(end_get - start_get,4)}sec')
 
@@ -109,36 +375,42 @@ class apis:
                     return custom_attributes
             else:
                 return None
+        except ise_unavailable:
+            ## A shed lookup says nothing about the endpoint; let the caller retry it later
+            raise
         except requests.exceptions.RequestException as err:
             logger.warning(f'An error occurred: {err}')
             return None
 
     def bulk_update_put(self, update):
-        url = f'{self.fqdn}/api/v1/endpoint/bulk'
+        url_suffix = '/api/v1/endpoint/bulk'
         try:
-            response = requests.put(url, headers=self.headers, json=update, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            response = self._request('PUT', url_suffix, json=update)
             logger.info(f'endpoint bulk update api response = {response.json()}')
+            return response.ok
         except requests.exceptions.RequestException as err:
             logger.warning(f'unable to update endpoints within ISE - {err}')
+            return False
 
     def bulk_update_post(self, update):
-        url = f'{self.fqdn}/api/v1/endpoint/bulk'
+        url_suffix = '/api/v1/endpoint/bulk'
         try:
-            response = requests.post(url, headers=self.headers, json=update, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            response = self._request('POST', url_suffix, json=update)
             logger.info(f'endpoint bulk create api response = {response.json()}')
+            return response.ok
         except requests.exceptions.RequestException as err:
             logger.warning(f'unable to update endpoints within ISE - {err}')
+            return False
 
     async def get_ise_endpoint_async(self, mac):
-        url = f'{self.fqdn}/api/v1/endpoint/{mac}'
+        url_suffix = f'/api/v1/endpoint/{mac}'
         try:
             start_get = time.time()
-            response = requests.get(url, headers=self.headers, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
+            status_code, result = await self._request_async('GET', url_suffix)
             end_get = time.time()
             logger.debug(f'API call to ISE for {mac} - ISE response time: {round(end_get - start_get,4)}sec')
             ## If an endpoint exists...
-            if response.status_code != 404:
-                result = response.json()
+            if status_code != 404:
                 custom_attributes = result.get('customAttributes', {})
                 if custom_attributes ==  None:
                     return "no_values"
@@ -150,22 +422,52 @@ class apis:
                     return custom_attributes
             else:
                 return None
-        except requests.exceptions.RequestException as err:
+        except ise_unavailable:
+            ## A shed lookup says nothing about the endpoint; let the caller retry it later
+            raise
+        except async_errors as err:
             logger.warning(f'An error occurred: {err}')
             return None
 
-    async def bulk_update_put_async(self, update):
-        url = f'{self.fqdn}/api/v1/endpoint/bulk'
+    ## Return one page of ISE endpoints (with customAttributes), or None if the page could not be fetched
+    async def get_ise_endpoints_page_async(self, page, size, filters=None):
+        url_suffix = '/api/v1/endpoint'
+        params = {'page': page, 'size': size}
+        if filters:
+            params['filter'] = filters
         try:
-            response = requests.put(url, headers=self.headers, json=update, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
-            logger.info(f'endpoint bulk update api response = {response.json()}')
-        except requests.exceptions.RequestException as err:
+            start_get = time.time()
+            status_code, result = await self._request_async('GET', url_suffix, params=params)
+            end_get = time.time()
+            logger.debug(f'API call to ISE for endpoint page {page} - ISE response time: {round(end_get - start_get,4)}sec')
+            if status_code != 200:
+                logger.warning(f'unable to gather ISE endpoints page {page} - status code {status_code}')
+                return None
+            ## Some ISE releases wrap list results in a 'response' object
+            if isinstance(result, dict):
+                result = result.get('response', [])
+            return result or []
+        except async_errors as err:
+            logger.warning(f'unable to gather ISE endpoints page {page} - {err}')
+            return None
+
+    ## Bulk calls return TRUE once ISE has accepted the request; 'exchange' as for _request_async
+    async def bulk_update_put_async(self, update, exchange=None):
+        url_suffix = '/api/v1/endpoint/bulk'
+        try:
+            status_code, result = await self._request_async('PUT', url_suffix, exchange, json=update)
+            logger.info(f'endpoint bulk update api response = {result}')
+            return 200 <= status_code < 300
+        except async_errors as err:
             logger.warning(f'unable to update endpoints within ISE - {err}')
+            return False
 
-    async def bulk_update_post_async(self, update):
-        url = f'{self.fqdn}/api/v1/endpoint/bulk'
+    async def bulk_update_post_async(self, update, exchange=None):
+        url_suffix = '/api/v1/endpoint/bulk'
         try:
-            response = requests.post(url, headers=self.headers, json=update, auth=HTTPBasicAuth(self.user, self.pwd), verify=False)
-            logger.info(f'endpoint bulk create api response = {response.json()}')
-        except requests.exceptions.RequestException as err:
-            logger.warning(f'unable to update endpoints within ISE - {err}')
\ No newline at end of file
+            status_code, result = await self._request_async('POST', url_suffix, exchange, json=update)
+            logger.info(f'endpoint bulk create api response = {result}')
+            return 200 <= status_code < 300
+        except async_errors as err:
+            logger.warning(f'unable to update endpoints within ISE - {err}')
+            return False
\ No newline at end of file
@@ -0,0 +1,70 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+## Number of recent bulk calls kept for latency percentiles and throughput
+window_size = 100
+
+class batcher:
+    def __init__(self, min_size=25, max_size=500, target_latency=2.0, min_timeout=3.0, max_timeout=30.0):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max_size
+        self.target_latency = target_latency
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout = min_timeout
+        ## (seconds, endpoints, accepted) per recent bulk call
+        self.calls = deque(maxlen=window_size)
+        self.failures = 0
+
+    ## Feed back one bulk call: shrink on failure / slow responses, grow while ISE answers well inside the target
+    def record(self, count, elapsed, ok, timed_out=False):
+        self.calls.append((elapsed, count, ok))
+        previous = self.size
+        if not ok:
+            self.failures += 1
+            self.size = max(self.min_size, self.size // 2)
+        elif elapsed > self.target_latency:
+            self.size = max(self.min_size, int(self.size * self.target_latency / elapsed))
+        elif elapsed < self.target_latency / 2 and count >= self.size:
+            self.size = min(self.max_size, self.size + max(1, self.size // 4))
+        ## Allow three times the slowest typical response, and back off further after a call that timed out
+        timeout = 3 * self.percentile(95)
+        if timed_out:
+            timeout = max(timeout, self.timeout * 2)
+        self.timeout = min(self.max_timeout, max(self.min_timeout, timeout))
+        if self.size != previous:
+            logger.debug(f'ISE bulk chunk size {previous} -> {self.size} (call of {count} took {round(elapsed,3)}sec, accepted={ok}), timeout {round(self.timeout,2)}sec')
+
+    def percentile(self, pct):
+        if not self.calls:
+            return 0.0
+        latencies = sorted(elapsed for elapsed, count, ok in self.calls)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))]
+
+    ## Per-call dict handed to the bulk API method: carries the current timeout in, the HTTP exchange timing out
+    def exchange(self):
+        return {'timeout': self.timeout}
+
+    ## Await 'request' (a bulk call coroutine returning TRUE when accepted, created with 'exchange') and feed back the
+    ## latency of its HTTP exchange alone: waiting for a node slot or rate-limit token is queueing, not ISE slowness
+    async def send(self, request, count, exchange):
+        ok = await request
+        if 'elapsed' not in exchange:
+            ## Shed before reaching ISE (rate limit / circuit breaker); says nothing about ISE latency
+            return ok
+        self.record(count, exchange['elapsed'], bool(ok), timed_out=exchange['timed_out'])
+        if exchange['timed_out']:
+            raise asyncio.TimeoutError()
+        return ok
+
+    def stats(self):
+        busy = sum(elapsed for elapsed, count, ok in self.calls)
+        accepted = sum(count for elapsed, count, ok in self.calls if ok)
+        return {'size': self.size, 'timeout': round(self.timeout, 2), 'p50': round(self.percentile(50), 3),
+                'p95': round(self.percentile(95), 3), 'p99': round(self.percentile(99), 3),
+                'endpoints_per_sec': round(accepted / busy, 1) if busy else 0, 'failures': self.failures}
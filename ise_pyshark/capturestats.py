@@ -0,0 +1,117 @@
+import re
+import time
+import logging
+import threading
+import psutil
+
+logger = logging.getLogger(__name__)
+
+phases = ('startup', 'steady')
+
+## Exit summaries dumpcap and tshark print on stderr for each capture interface
+dumpcap_drops = re.compile(r"Packets received/dropped on interface '[^']*': \d+/\d+ \(pcap:(\d+)/dumpcap:(\d+)/flushed:\d+/ps_ifdrop:(\d+)\)")
+tshark_drops = re.compile(r'^(\d+) packets? dropped from ', re.MULTILINE)
+
+## Capture buffer drops from a dumpcap / tshark stderr summary: {'buffer': libpcap ps_drop plus dumpcap's own ring buffer drops,
+## 'ps_ifdrop': interface drops libpcap saw while the capture ran (dumpcap only)}; None if the process printed no summary
+def buffer_drops(stderr):
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', 'replace')
+    drops = None
+    for pcap, dumpcap, ps_ifdrop in dumpcap_drops.findall(stderr):
+        drops = drops or {'buffer': 0, 'ps_ifdrop': 0}
+        drops['buffer'] += int(pcap) + int(dumpcap)
+        drops['ps_ifdrop'] += int(ps_ifdrop)
+    for dropped in tshark_drops.findall(stderr):
+        drops = drops or {'buffer': 0}
+        drops['buffer'] += int(dropped)
+    return drops
+
+class capturestats:
+    def __init__(self, interface, startup_window=10.0, sample_interface=True):
+        self.interface = interface
+        ## Interface drops are a whole-interface counter, so only one capturestats per interface should sample them
+        ## (the others, ex. the native decoder's capture or further --workers processes, report queue drops only)
+        self.sample_interface = sample_interface
+        ## Drops within this many seconds of a capture (re)start count as start-up losses, later ones as steady state
+        self.startup_window = startup_window
+        self.lock = threading.Lock()
+        self.packets = 0
+        self.restarts = -1
+        self.queue_drops = {phase: 0 for phase in phases}
+        self.interface_drops = {phase: 0 for phase in phases}
+        ## Summed over every capture instance that has exited; None until one reports (pyshark's tshark never does)
+        self.capture_buffer_drops = None
+        self.started = None
+        self.baseline = None
+        self.in_startup = False
+
+    ## Inbound packets the NIC / kernel dropped on the whole capture interface (psutil dropin, from /proc/net/dev or the
+    ## platform equivalent); not the capture's own buffer drops, and shared by every capture on the interface
+    def _interface_dropped(self):
+        if not self.sample_interface:
+            return 0
+        counters = psutil.net_io_counters(pernic=True).get(self.interface)
+        return counters.dropin if counters is not None else 0
+
+    ## Call whenever a capture instance starts
+    def start(self):
+        with self.lock:
+            self._close_startup()
+            self.restarts += 1
+            self.started = time.monotonic()
+            self.baseline = self._interface_dropped()
+            self.in_startup = True
+
+    ## Fold interface drops seen so far into the current phase and leave the start-up phase once its window has passed
+    def _sample(self):
+        if self.baseline is None:
+            return
+        current = self._interface_dropped()
+        phase = 'startup' if self.in_startup else 'steady'
+        self.interface_drops[phase] += max(0, current - self.baseline)
+        self.baseline = current
+        if self.in_startup and time.monotonic() - self.started >= self.startup_window:
+            self.in_startup = False
+
+    def _close_startup(self):
+        if self.in_startup:
+            self._sample()
+            self.in_startup = False
+
+    def _phase(self):
+        if self.in_startup and time.monotonic() - self.started >= self.startup_window:
+            self._sample()
+        return 'startup' if self.in_startup else 'steady'
+
+    def packet(self):
+        self.packets += 1
+
+    def queue_drop(self):
+        with self.lock:
+            self.queue_drops[self._phase()] += 1
+
+    ## Call with a fieldcapture / rawcapture's 'drops' once the capture has been closed. dumpcap and tshark only report
+    ## buffer drops when they exit, as totals for the whole capture, so these are not split into start-up and steady state.
+    def buffer_drop(self, drops):
+        if not drops:
+            return
+        with self.lock:
+            self.capture_buffer_drops = self.capture_buffer_drops or {}
+            for name, count in drops.items():
+                self.capture_buffer_drops[name] = self.capture_buffer_drops.get(name, 0) + count
+
+    ## Live drop counters are the processing queue's and, if sampled, the interface's NIC / kernel counter ('interface_nic');
+    ## the capture's own buffer drops ('capture_buffer') only appear once a capture instance has exited
+    def stats(self):
+        with self.lock:
+            self._phase()
+            self._sample()
+            stats = {'packets': self.packets, 'restarts': max(self.restarts, 0)}
+            for phase in phases:
+                stats[f'{phase}_drops'] = {'queue': self.queue_drops[phase]}
+                if self.sample_interface:
+                    stats[f'{phase}_drops']['interface_nic'] = self.interface_drops[phase]
+            if self.capture_buffer_drops is not None:
+                stats['capture_buffer'] = dict(self.capture_buffer_drops)
+            return stats
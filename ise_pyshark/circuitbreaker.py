@@ -0,0 +1,59 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+## Breaker states
+state_closed = 'closed'
+state_open = 'open'
+state_half_open = 'half-open'
+
+class circuitbreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, name='ISE API'):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.state = state_closed
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.shed = 0
+        self.trips = 0
+
+    ## Return TRUE if a call may proceed; once 'reset_timeout' has passed an open breaker lets a single probe through
+    def allow(self):
+        with self.lock:
+            if self.state == state_closed:
+                return True
+            if self.state == state_open and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = state_half_open
+                logger.warning(f'{self.name} circuit breaker half-open - probing for recovery')
+            if self.state == state_half_open and not self.probing:
+                self.probing = True
+                return True
+            self.shed += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != state_closed:
+                logger.warning(f'{self.name} circuit breaker closed - calls resumed')
+            self.state = state_closed
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == state_half_open or (self.state == state_closed and self.failures >= self.failure_threshold):
+                if self.state == state_closed:
+                    self.trips += 1
+                self.state = state_open
+                self.opened_at = time.monotonic()
+                logger.warning(f'{self.name} circuit breaker open after {self.failures} consecutive failures - pausing calls for {self.reset_timeout}sec')
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips, 'shed': self.shed}
@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+## Value array layout shared with parser / eps: mac=0, protocol=1, ip=2, values 3-10, weights 11-18
+value_fields = range(3, 11)
+weight_offset = 8
+
+class coalescer:
+    def __init__(self, redis_eps, redis_db, flush_interval=1.0, max_entries=500):
+        self.redis_eps = redis_eps
+        self.redis_db = redis_db
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        ## mac -> merged value array awaiting the next flush
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.observations = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.flusher = None
+        if self.flush_interval > 0:
+            self.flusher = threading.Thread(target=self._run, name='redis-coalescer', daemon=True)
+            self.flusher.start()
+
+    ## Apply the eps weighted-merge rules in memory: higher weight wins per field, new protocols are appended
+    @staticmethod
+    def merge(existing, values):
+        for i in value_fields:
+            if int(values[i + weight_offset]) > int(existing[i + weight_offset]):
+                existing[i] = values[i]
+                existing[i + weight_offset] = values[i + weight_offset]
+        if values[1] != existing[1]:
+            known = set(str(existing[1]).split(','))
+            for proto in str(values[1]).split(','):
+                if proto not in known:
+                    known.add(proto)
+                    existing[1] = f'{existing[1]},{proto}'
+        return existing
+
+    ## Buffer a parsed observation; flushes inline once 'max_entries' distinct MACs are pending
+    def add(self, values):
+        if values is None:
+            return
+        if self.flush_interval <= 0:
+            ## Write-through mode
+            self.redis_eps.add_or_update_entry(self.redis_db, values)
+            return
+        with self.lock:
+            self.observations += 1
+            existing = self.entries.get(values[0])
+            if existing is None:
+                self.entries[values[0]] = list(values)
+            else:
+                self.merge(existing, values)
+            pending = len(self.entries)
+        if pending >= self.max_entries:
+            self.flush()
+
+    ## Write every pending entry to redis in one pipelined batch
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.entries:
+                    return
+                batch = list(self.entries.values())
+                self.entries = {}
+            try:
+                self.redis_eps.add_or_update_entries(self.redis_db, batch)
+                self.flushed += len(batch)
+                self.flushes += 1
+            except Exception as e:
+                logger.warning(f'unable to flush {len(batch)} coalesced records to redis - {e}')
+                ## Put the batch back in front of anything buffered since, so the next flush retries it
+                with self.lock:
+                    for values in batch:
+                        newer = self.entries.get(values[0])
+                        self.entries[values[0]] = values if newer is None else self.merge(values, newer)
+
+    def _run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    ## Stop the background flusher and drain anything still buffered
+    def close(self):
+        self.stop_event.set()
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join(timeout=max(self.flush_interval, 1.0))
+        self.flush()
+        logger.debug(f'redis coalescer drained: {self.stats()}')
+
+    def stats(self):
+        ratio = round(self.observations / self.flushed, 2) if self.flushed else 0
+        return {'observations': self.observations, 'flushed': self.flushed, 'flushes': self.flushes, 'pending': len(self.entries), 'coalesce_ratio': ratio}
@@ -1,5 +1,6 @@
 import redis
 import logging
+import hashlib
 import time
 from datetime import datetime
 
@@ -55,6 +56,153 @@ remote_example_data = {
     'up_to_date': 'False'
 }
 
+## Weighted merge of one observation into 'endpoint:<mac>', run atomically inside redis (mirrors _merge_entry_python)
+## KEYS[1] = endpoint hash, KEYS[2] = endpoints:macs set, KEYS[3] = (optional) endpoints:dirty set of MACs awaiting ISE sync
+## ARGV[1] = expiry in seconds, ARGV[2..n] = field / value pairs of the new observation
+## Returns 1 if the entry was created, 2 if it was updated, 0 if the existing values were kept
+## Created / updated records also get a 'digest' field (see endpoint_digest)
+merge_script = """
+local function split(value)
+    local parts, start = {}, 1
+    while true do
+        local index = string.find(value, ',', start, true)
+        if not index then
+            parts[#parts + 1] = string.sub(value, start)
+            return parts
+        end
+        parts[#parts + 1] = string.sub(value, start, index - 1)
+        start = index + 1
+    end
+end
+
+local digest_fields = {'mac', 'protocols', 'ip', 'name', 'vendor', 'hw', 'sw', 'productID', 'serial', 'device_type',
+    'name_weight', 'vendor_weight', 'hw_weight', 'sw_weight', 'productID_weight', 'serial_weight', 'device_type_weight'}
+
+-- Must produce the same value as eps.endpoint_digest()
+local function digest(values)
+    local canonical = {}
+    for i = 1, #digest_fields do
+        canonical[i] = values[i] or ''
+    end
+    local seen, protocols = {}, {}
+    for _, proto in ipairs(split(canonical[2])) do
+        if not seen[proto] then
+            seen[proto] = true
+            protocols[#protocols + 1] = proto
+        end
+    end
+    table.sort(protocols)
+    canonical[2] = table.concat(protocols, ',')
+    canonical[4] = (string.gsub(canonical[4], "'", "\u2019"))
+    return redis.sha1hex(table.concat(canonical, '\\31'))
+end
+
+local function store_digest()
+    local values = redis.call('HMGET', KEYS[1], unpack(digest_fields))
+    for i = 1, #digest_fields do
+        if not values[i] then
+            values[i] = ''
+        end
+    end
+    redis.call('HSET', KEYS[1], 'digest', digest(values))
+end
+
+local new = {}
+for i = 2, #ARGV, 2 do
+    new[ARGV[i]] = ARGV[i + 1]
+end
+
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local mapping = {}
+    for i = 2, #ARGV do
+        mapping[#mapping + 1] = ARGV[i]
+    end
+    mapping[#mapping + 1] = 'synced_to_ise'
+    mapping[#mapping + 1] = 'False'
+    redis.call('HSET', KEYS[1], unpack(mapping))
+    store_digest()
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('SADD', KEYS[2], new['mac'])
+    if KEYS[3] then
+        redis.call('SADD', KEYS[3], new['mac'])
+    end
+    return 1
+end
+
+local fields = {'id', 'name', 'vendor', 'hw', 'sw', 'productID', 'serial', 'device_type'}
+local lookup = {'protocols'}
+for _, field in ipairs(fields) do
+    lookup[#lookup + 1] = field .. '_weight'
+end
+local existing = redis.call('HMGET', KEYS[1], unpack(lookup))
+
+local changes = {}
+for i, field in ipairs(fields) do
+    local weight = field .. '_weight'
+    if (tonumber(new[weight]) or 0) > (tonumber(existing[i + 1]) or 0) then
+        changes[#changes + 1] = weight
+        changes[#changes + 1] = new[weight]
+        changes[#changes + 1] = field
+        changes[#changes + 1] = new[field] or ''
+    end
+end
+
+local protocols = existing[1] or ''
+if new['protocols'] ~= protocols then
+    local known = {}
+    for _, proto in ipairs(split(protocols)) do
+        known[proto] = true
+    end
+    local appended = protocols
+    for _, proto in ipairs(split(new['protocols'])) do
+        if not known[proto] then
+            known[proto] = true
+            appended = appended .. ',' .. proto
+        end
+    end
+    if appended ~= protocols then
+        changes[#changes + 1] = 'protocols'
+        changes[#changes + 1] = appended
+    end
+end
+
+if #changes == 0 then
+    return 0
+end
+changes[#changes + 1] = 'synced_to_ise'
+changes[#changes + 1] = 'False'
+redis.call('HSET', KEYS[1], unpack(changes))
+store_digest()
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], new['mac'])
+if KEYS[3] then
+    redis.call('SADD', KEYS[3], new['mac'])
+end
+return 2
+"""
+
+## Compare stored digests server-side: KEYS[i] = endpoint hash, ARGV[i] = expected digest
+## Returns the (1-based) positions whose stored digest is missing or different
+changed_script = """
+local changed = {}
+for i = 1, #KEYS do
+    if redis.call('HGET', KEYS[i], 'digest') ~= ARGV[i] then
+        changed[#changed + 1] = i
+    end
+end
+return changed
+"""
+
+## Fields (in order) covered by an endpoint digest: everything sent to ISE, excluding the unused id / id_weight
+digest_fields = ['mac', 'protocols', 'ip', 'name', 'vendor', 'hw', 'sw', 'productID', 'serial', 'device_type',
+                 'name_weight', 'vendor_weight', 'hw_weight', 'sw_weight', 'productID_weight', 'serial_weight', 'device_type_weight']
+
+## Set of MACs whose local record changed since the last ISE sync cycle (local db only)
+dirty_key = 'endpoints:dirty'
+
+## Lifetime of an endpoint record before it is purged due to inactivity (15min interval)
+endpoint_ttl = 900
+
 class eps:
     def __init__(self,):
         start_time = time.time()
@@ -70,11 +218,30 @@ class eps:
         self.local_db.hset(f"endpoint:{mac_address}", mapping=local_example_data)
         self.remote_db.hset(f"endpoint:{mac_address}", mapping=remote_example_data)
         # print(f'after template, local entries: {local_db.dbsize()}, remote entries: {remote_db.dbsize()}')
+        self._register_scripts()
         end_time = time.time()
         logger.warning(f'redis DB creation - Completed: {round(end_time - start_time,4)}sec')
 
-    ## Compare the values provided against either the local or remote cache redis DB
-    def add_or_update_entry(self, redis_db, data_array, ise_sync=False):
+    ## Scripts are registered once; each call is a single EVALSHA (reloaded automatically on NOSCRIPT)
+    def _register_scripts(self):
+        self.merge_script = self.local_db.register_script(merge_script)
+        self.changed_script = self.local_db.register_script(changed_script)
+        self.use_merge_script = True
+
+    ## Stable digest of the values synced to ISE; protocol order and the ISE apostrophe substitution are normalised
+    @staticmethod
+    def endpoint_digest(entry):
+        canonical = [str(entry.get(field, '')) for field in digest_fields]
+        canonical[1] = ','.join(sorted(set(canonical[1].split(','))))
+        canonical[3] = canonical[3].replace("'", "’")
+        return hashlib.sha1('\x1f'.join(canonical).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _redis_id(redis_db):
+        return redis_db.connection_pool.connection_kwargs.get('db', 0)
+
+    ## Map an observation (value array for the local db, field dict for the remote cache) to redis hash fields
+    def _new_entry(self, redis_db, data_array):
         # Map array values to field names
         fields = [
             'mac', 'protocols', 'ip', 'id', 'name', 'vendor', 'hw', 'sw', 
@@ -83,7 +250,7 @@ class eps:
             'serial_weight', 'device_type_weight'
         ]
         # Identify Redis database (local or remote)
-        redis_id = redis_db.connection_pool.connection_kwargs.get('db', 0)
+        redis_id = self._redis_id(redis_db)
         if redis_id == 0:       ## If referring to the parser's local redis db
             new_entry = {fields[i]: str(data_array[i]) for i in range(len(fields))}
         elif redis_id == 1:     ## If utilizing the remote cache db
@@ -91,6 +258,64 @@ class eps:
 
         # Add dynamically generated timestamp
         new_entry['timestamp'] = datetime.now().isoformat()
+        return new_entry
+
+    ## Compare the values provided against either the local or remote cache redis DB
+    def add_or_update_entry(self, redis_db, data_array, ise_sync=False):
+        new_entry = self._new_entry(redis_db, data_array)
+        if self.use_merge_script:
+            try:
+                self._merge_entry_script(redis_db, new_entry)
+                return
+            except redis.exceptions.ResponseError as e:
+                ## Scripting unavailable (ex. disabled or restricted by ACLs); use the client-side merge from now on
+                logger.warning(f'redis merge script unavailable, falling back to client-side merge - {e}')
+                self.use_merge_script = False
+                ## The script may have failed after a partial HSET, so the values already match; write and mark dirty regardless
+                self._merge_entry_python(redis_db, new_entry, force=True)
+                return
+        self._merge_entry_python(redis_db, new_entry)
+
+    ## Merge several observations with a single pipelined round trip (used when flushing coalesced entries)
+    def add_or_update_entries(self, redis_db, data_arrays):
+        new_entries = [self._new_entry(redis_db, data_array) for data_array in data_arrays]
+        if not new_entries:
+            return
+        if self.use_merge_script:
+            try:
+                with redis_db.pipeline(transaction=False) as pipe:
+                    for new_entry in new_entries:
+                        self._merge_entry_script(pipe, new_entry)
+                    pipe.execute()
+                logger.debug(f'{len(new_entries)} coalesced records merged into redis')
+                return
+            except redis.exceptions.ResponseError as e:
+                logger.warning(f'redis merge script unavailable, falling back to client-side merge - {e}')
+                self.use_merge_script = False
+                for new_entry in new_entries:
+                    self._merge_entry_python(redis_db, new_entry, force=True)
+                return
+        for new_entry in new_entries:
+            self._merge_entry_python(redis_db, new_entry)
+
+    ## Merge the observation server-side in a single EVALSHA round trip
+    def _merge_entry_script(self, redis_db, new_entry):
+        mac = new_entry['mac']
+        args = [endpoint_ttl]
+        for field, value in new_entry.items():
+            args.extend((field, value))
+        keys = [f"endpoint:{mac}", "endpoints:macs"]
+        if self._redis_id(redis_db) == 0:
+            keys.append(dirty_key)
+        result = self.merge_script(keys=keys, args=args, client=redis_db)
+        if result == 1:
+            logger.debug(f'Record for MAC {mac} added to database')
+        elif result == 2:
+            logger.debug(f'Record for MAC {mac} updated.')
+
+    ## Client-side weighted merge (HGETALL, compare, MULTI/HSET/EXPIRE/SADD)
+    ## 'force' rewrites the record (fresh digest, unsynced, dirty) even when no weight or protocol changed
+    def _merge_entry_python(self, redis_db, new_entry, force=False):
         mac = new_entry['mac']
         existing_data = redis_db.hgetall(f"endpoint:{mac}")
 
@@ -122,9 +347,10 @@ class eps:
                         existing_data['protocols'] = existing_data['protocols'] + ',' + proto
                         updated = True
 
-            if updated:
+            if updated or force:
                 # Update the 'synced_to_ise' field if we're updating the record
                 existing_data['synced_to_ise'] = 'False'
+                existing_data['digest'] = self.endpoint_digest(existing_data)
                 logger.debug(f'Record for MAC {mac} updated.')
             else:
                 # Update only the timestamp if weights are not higher to show data is still valid as of new time
@@ -135,6 +361,7 @@ class eps:
             # If no existing data, create a new entry
             existing_data = new_entry
             existing_data['synced_to_ise'] = 'False'
+            existing_data['digest'] = self.endpoint_digest(existing_data)
             logger.debug(f'Record for MAC {mac} added to database')
 
         with redis_db.pipeline() as pipe:
@@ -143,164 +370,139 @@ class eps:
                 # Add or update the record in the local database
                 pipe.hset(f"endpoint:{mac}", mapping=existing_data)
                 # Add a lifetime to the mac address record for when it should be purged due to inactivity (15min interval)
-                pipe.expire(f"endpoint:{mac}",900)
+                pipe.expire(f"endpoint:{mac}",endpoint_ttl)
                 pipe.sadd("endpoints:macs", mac)
+                if self._redis_id(redis_db) == 0:
+                    pipe.sadd(dirty_key, mac)
                 pipe.execute()
                 # logger.debug(f'redis execution success')
             except:
                 logger.warning(f'redis execution error for mac {mac}')
 
+    ## Build the ISE custom attribute values for a local redis record
+    @staticmethod
+    def ise_attributes(row):
+        ## Does not include "id" nor "id_weight"
+        return {
+                "isepyHostname": row['name'].replace("’","'"),
+                "isepyVendor": row['vendor'],
+                "isepyModel": row['hw'],
+                "isepyOS": row['sw'],
+                "isepyDeviceID": row['productID'],
+                "isepySerial": row['serial'],
+                "isepyType": row['device_type'],
+                "isepyProtocols": row['protocols'],
+                "isepyIP": row['ip'],
+                "isepyCertainty" : str(row['name_weight'])+","+str(row['vendor_weight'])+","+str(row['hw_weight'])+","+str(row['sw_weight'])+","+str(row['productID_weight'])+","+str(row['serial_weight'])+","+str(row['device_type_weight'])
+                }
+
+    ## Map ISE custom attribute values back onto the remote cache fields they are compared against
+    @staticmethod
+    def _remote_filtered(mac_address, values):
+        certainties = values.get('isepyCertainty', '').split(',')
+        return {
+            'mac':mac_address,
+            'protocols': values.get('isepyProtocols', ''),
+            'ip': values.get('isepyIP', ''),
+            'id':'',
+            'name': (values.get('isepyHostname', "")).replace("'","’"),
+            'vendor': values.get('isepyVendor', ''),
+            'hw': values.get('isepyModel', ''),
+            'sw': values.get('isepyOS', ''),
+            'productID': values.get('isepyDeviceID', ''),
+            'serial': values.get('isepySerial', ''),
+            'device_type': values.get('isepyType', ''),
+            'id_weight':'0',
+            'name_weight':certainties[0],
+            'vendor_weight':certainties[1],
+            'hw_weight':certainties[2],
+            'sw_weight':certainties[3],
+            'productID_weight':certainties[4],
+            'serial_weight':certainties[5],
+            'device_type_weight':certainties[6]
+        }
+
     ## Compare the values provided against the remote cache DB and return TRUE or FALSE for entry presence
     def check_remote_cache(self, redis_db, mac_address, values):
-        existing_values = redis_db.hgetall(f"endpoint:{mac_address}")
-        
-        # Define the fields to check
-        fields = [
-            'mac', 'protocols', 'ip', 'id', 'name', 'vendor', 'hw', 'sw', 
-            'productID', 'serial', 'device_type', 'id_weight', 'name_weight', 
-            'vendor_weight', 'hw_weight', 'sw_weight', 'productID_weight', 
-            'serial_weight', 'device_type_weight'
-        ]
-
-        # Check if MAC address exists in the database
-        if existing_values:
-            # Decode the existing values from bytes to strings
-            existing_values_decoded = {k.decode('utf-8'): v.decode('utf-8') for k, v in existing_values.items()}
-
-            # Filter existing values to only include the specified fields
-            existing_filtered = {field: existing_values_decoded.get(field, '') for field in fields}
-
-            certainties = values.get('isepyCertainty', '').split(',')
-
-            # Create new_filtered by mapping values from 'values' dictionary to 'fields'
-            new_filtered = {
-                'mac':mac_address,
-                'protocols': values.get('isepyProtocols', ''),
-                'ip': values.get('isepyIP', ''),
-                'id':'',
-                'name': (values.get('isepyHostname', "")).replace("'","’"),
-                'vendor': values.get('isepyVendor', ''),
-                'hw': values.get('isepyModel', ''),
-                'sw': values.get('isepyOS', ''),
-                'productID': values.get('isepyDeviceID', ''),
-                'serial': values.get('isepySerial', ''),
-                'device_type': values.get('isepyType', ''),
-                'id_weight':'0',
-                'name_weight':certainties[0],
-                'vendor_weight':certainties[1],
-                'hw_weight':certainties[2],
-                'sw_weight':certainties[3],
-                'productID_weight':certainties[4],
-                'serial_weight':certainties[5],
-                'device_type_weight':certainties[6]
-            }
-
-            # Compare the filtered existing values with new values
-            if existing_filtered != new_filtered:
-                logger.debug(f"redis remote cache MAC address {mac_address} exists and has different values")
-                # logger.debug(f'{mac_address} existing: {existing_filtered} - new values: {new_filtered}')
-                return False
-            else:
-                logger.debug(f"redis remote cache MAC address {mac_address} exists and already has the same values")
-                return True
-        else:
+        expected = self.endpoint_digest(self._remote_filtered(mac_address, values))
+        existing = redis_db.hget(f"endpoint:{mac_address}", 'digest')
+        if existing is None:
             logger.debug(f"no entry exists in redis remote cache for MAC address {mac_address}")
             return False
+        if existing.decode('utf-8') != expected:
+            logger.debug(f"redis remote cache MAC address {mac_address} exists and has different values")
+            return False
+        logger.debug(f"redis remote cache MAC address {mac_address} exists and already has the same values")
+        return True
 
     ## Compare the values provided against the remote cache DB and return TRUE or FALSE for entry presence
     async def check_remote_cache_async(self, redis_db, mac_address, values):
-        existing_values = redis_db.hgetall(f"endpoint:{mac_address}")
-        
-        # Define the fields to check
-        fields = [
-            'mac', 'protocols', 'ip', 'id', 'name', 'vendor', 'hw', 'sw', 
-            'productID', 'serial', 'device_type', 'id_weight', 'name_weight', 
-            'vendor_weight', 'hw_weight', 'sw_weight', 'productID_weight', 
-            'serial_weight', 'device_type_weight'
-        ]
-
-        # Check if MAC address exists in the database
-        if existing_values:
-            # Decode the existing values from bytes to strings
-            existing_values_decoded = {k.decode('utf-8'): v.decode('utf-8') for k, v in existing_values.items()}
-
-            # Filter existing values to only include the specified fields
-            existing_filtered = {field: existing_values_decoded.get(field, '') for field in fields}
-
-            certainties = values.get('isepyCertainty', '').split(',')
-
-            # Create new_filtered by mapping values from 'values' dictionary to 'fields'
-            new_filtered = {
-                'mac':mac_address,
-                'protocols': values.get('isepyProtocols', ''),
-                'ip': values.get('isepyIP', ''),
-                'id':'',
-                'name': (values.get('isepyHostname', "")).replace("'","’"),
-                'vendor': values.get('isepyVendor', ''),
-                'hw': values.get('isepyModel', ''),
-                'sw': values.get('isepyOS', ''),
-                'productID': values.get('isepyDeviceID', ''),
-                'serial': values.get('isepySerial', ''),
-                'device_type': values.get('isepyType', ''),
-                'id_weight':'0',
-                'name_weight':certainties[0],
-                'vendor_weight':certainties[1],
-                'hw_weight':certainties[2],
-                'sw_weight':certainties[3],
-                'productID_weight':certainties[4],
-                'serial_weight':certainties[5],
-                'device_type_weight':certainties[6]
-            }
-
-            # Compare the filtered existing values with new values
-            if existing_filtered != new_filtered:
-                logger.debug(f"redis remote cache MAC address {mac_address} exists and has different values")
-                # logger.debug(f'{mac_address} existing: {existing_filtered} - new values: {new_filtered}')
-                return False
-            else:
-                logger.debug(f"redis remote cache MAC address {mac_address} exists and already has the same values")
-                return True
-        else:
-            logger.debug(f"no entry exists in redis remote cache for MAC address {mac_address}")
-            return False
+        return self.check_remote_cache(redis_db, mac_address, values)
+
+    ## Compare a batch of local records against the remote cache by digest; return the MACs that differ
+    def check_remote_cache_batch(self, redis_db, rows):
+        if not rows:
+            return set()
+        digests = [row.get('digest') or self.endpoint_digest(row) for row in rows]
+        keys = [f"endpoint:{row['mac']}" for row in rows]
+        changed = None
+        if self.use_merge_script:
+            try:
+                ## Server-side: only the positions of mismatched digests come back
+                positions = self.changed_script(keys=keys, args=digests, client=redis_db)
+                changed = {rows[int(i) - 1]['mac'] for i in positions}
+            except redis.exceptions.ResponseError as e:
+                logger.warning(f'redis digest script unavailable, falling back to client-side comparison - {e}')
+                self.use_merge_script = False
+        if changed is None:
+            with redis_db.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.hget(key, 'digest')
+                existing = pipe.execute()
+            changed = {row['mac'] for row, digest, stored in zip(rows, digests, existing)
+                       if stored is None or stored.decode('utf-8') != digest}
+        logger.debug(f'redis remote cache batch check: {len(changed)} of {len(rows)} endpoints differ')
+        return changed
+
+    async def check_remote_cache_batch_async(self, redis_db, rows):
+        return self.check_remote_cache_batch(redis_db, rows)
+
+    ## Atomically take the set of MACs changed since the last call and fetch their records in one pipelined batch
+    def _pop_dirty_entries(self, local_redis):
+        with local_redis.pipeline() as pipe:
+            pipe.smembers(dirty_key)
+            pipe.delete(dirty_key)
+            mac_addresses, _ = pipe.execute()
+        if not mac_addresses:
+            return []
+        with local_redis.pipeline(transaction=False) as pipe:
+            for mac in mac_addresses:
+                pipe.hgetall(f"endpoint:{mac.decode('utf-8')}")
+            entries = pipe.execute()
 
-    ## Retrieve all MAC addresses stored in the local database
-    def updated_local_entries(self, local_redis):
-        mac_addresses = local_redis.smembers("endpoints:macs")
         updated_records = []
-
-        for mac in mac_addresses:
-            # Decode MAC address from bytes to string
-            mac_str = mac.decode('utf-8')
-            
-            # Retrieve the hash for each MAC address
-            entry = local_redis.hgetall(f"endpoint:{mac_str}")
+        for entry in entries:
             entry = {k.decode('utf-8'): v.decode('utf-8') for k, v in entry.items()}
-
-            # Check if the 'synced_to_ise' field is set to 'False'
+            # Skip records that expired since being marked; keep only those not yet synced
             if entry.get('synced_to_ise') == 'False':
                 updated_records.append(entry)
-
         return updated_records
 
-    ## Retrieve all MAC addresses stored in the local database
-    async def updated_local_entries_async(self, local_redis):
-        mac_addresses = local_redis.smembers("endpoints:macs")
-        updated_records = []
-
-        for mac in mac_addresses:
-            # Decode MAC address from bytes to string
-            mac_str = mac.decode('utf-8')
-            
-            # Retrieve the hash for each MAC address
-            entry = local_redis.hgetall(f"endpoint:{mac_str}")
-            entry = {k.decode('utf-8'): v.decode('utf-8') for k, v in entry.items()}
+    ## Put MACs back into the dirty set (ex. when a sync cycle fails part way through)
+    def mark_dirty(self, local_redis, mac_addresses):
+        if mac_addresses:
+            try:
+                local_redis.sadd(dirty_key, *mac_addresses)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f'unable to re-queue {len(mac_addresses)} endpoints for ISE sync - {e}')
 
-            # Check if the 'updated' field is set to 'True'
-            if entry.get('synced_to_ise') == 'False':
-                updated_records.append(entry)
+    ## Retrieve the local entries changed since the last sync cycle
+    def updated_local_entries(self, local_redis):
+        return self._pop_dirty_entries(local_redis)
 
-        return updated_records
+    ## Retrieve the local entries changed since the last sync cycle
+    async def updated_local_entries_async(self, local_redis):
+        return self._pop_dirty_entries(local_redis)
 
     # Print all entries of defined redis DB
     def print_endpoints(self,redis_db):
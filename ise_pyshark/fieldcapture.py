@@ -0,0 +1,259 @@
+import json
+import shutil
+import logging
+import binascii
+import threading
+import subprocess
+from .capturestats import buffer_drops
+
+logger = logging.getLogger(__name__)
+
+## The only tshark fields the parser callbacks read; everything else in the dissection tree is never emitted
+fields = ['frame.protocols', 'eth.src', 'wlan.sa', 'ip.src',
+          'http.user_agent', 'http.request.line', 'http.file_data',
+          'sip.msg_hdr',
+          'browser.command', 'browser.server', 'browser.os_major', 'browser.os_minor', 'nbdgm.src.ip', 'nbdgm.source_name',
+          'dns.count.answers', 'dns.count.auth_rr', 'dns.count.add_rr', 'dns.resp.name', 'dns.resp.type', 'dns.resp.len',
+          'dns.txt', 'dns.txt.length']
+## '-T ek' writes field names with '_' in place of '.'
+ek_fields = {field.replace('.', '_'): field for field in fields}
+ek_fields.update({field: field for field in fields})
+
+## Section names pyshark's JSON layers use for mDNS resource records, in packet order
+mdns_sections = [('Answers', 'dns.count.answers'), ('Authoritative nameservers', 'dns.count.auth_rr'), ('Additional records', 'dns.count.add_rr')]
+record_types = {'1': 'A', '12': 'PTR', '16': 'TXT', '28': 'AAAA', '33': 'SRV', '47': 'NSEC'}
+
+## Minimal stand-in for a pyshark JsonLayer: same field lookup rules over the extracted fields only
+class fieldlayer:
+    def __init__(self, layer_name, all_fields, full_name=None, value=None):
+        self.layer_name = layer_name
+        self._full_name = full_name or layer_name
+        self._all_fields = all_fields
+        self.duplicate_layers = []
+        self.value = value
+
+    @property
+    def field_names(self):
+        return list(set([name.replace(self._full_name + '.', '') for name in self._all_fields if name.startswith(self._full_name)] +
+                        [name.rsplit('.', 1)[1] for name in self._all_fields if '.' in name]))
+
+    def get_field(self, name):
+        value = self._all_fields.get(name, self._all_fields.get(f'{self._full_name}.{name}'))
+        if value is not None:
+            return value
+        for field_name in self._all_fields:
+            if field_name.endswith(f'.{name}'):
+                return self._all_fields[field_name]
+        ## Dotted names such as nbdgm.src.ip are reached one part at a time (layer.src.ip)
+        prefix = f'{self._full_name}.{name}.'
+        nested = {field_name: value for field_name, value in self._all_fields.items() if field_name.startswith(prefix)}
+        if nested:
+            return fieldlayer(name, nested, full_name=f'{self._full_name}.{name}')
+        raise AttributeError(f'No such field {name}')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get_field(name)
+
+## Minimal stand-in for a pyshark Packet built from one line of 'tshark -T ek -e ...' output
+class fieldpacket:
+    def __init__(self, protocols, layers):
+        self.protocols = protocols
+        self.layers = layers
+
+    ## pyshark's include_raw JSON packets end with the raw layer of the innermost protocol
+    @property
+    def highest_layer(self):
+        return f'{self.protocols[-1].upper()}_RAW'
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return self.layers[item]
+        for layer in self.layers:
+            if layer.layer_name.lower() == item.lower():
+                return layer
+        raise KeyError('Layer does not exist in packet')
+
+    def __contains__(self, item):
+        try:
+            self[item]
+            return True
+        except KeyError:
+            return False
+
+    def __getattr__(self, item):
+        for layer in self.__dict__.get('layers', []):
+            if layer.layer_name.lower() == item.lower():
+                return layer
+        raise AttributeError(f'No attribute named {item}')
+
+class fieldcapture:
+    def __init__(self, interface=None, input_file=None, bpf_filter=None, display_filter=None, output_file=None, custom_parameters=None, tshark_path=None):
+        self.interface = interface
+        self.input_file = input_file
+        self.bpf_filter = bpf_filter
+        self.display_filter = display_filter
+        self.output_file = output_file
+        self.custom_parameters = custom_parameters or []
+        self.tshark_path = tshark_path or shutil.which('tshark') or 'tshark'
+        self.proc = None
+        ## Capture buffer drops tshark reported on stderr when it last exited (see capturestats.buffer_drops)
+        self.drops = None
+        ## close() runs from both the capture thread and shutdown; only one of them may reap tshark and read its summary
+        self.close_lock = threading.Lock()
+        self.packets = 0
+        self.errors = 0
+
+    def get_parameters(self):
+        params = [self.tshark_path, '-l', '-n', '-Q', '-T', 'ek']
+        for field in fields:
+            params += ['-e', field]
+        if self.input_file:
+            params += ['-r', self.input_file]
+        else:
+            params += ['-i', self.interface]
+            if self.bpf_filter:
+                params += ['-f', self.bpf_filter]
+            if self.output_file:
+                ## Without -P (or -x) tshark stops printing packets once it writes them to a file
+                params += ['-w', self.output_file, '-P']
+        if self.display_filter:
+            params += ['-Y', self.display_filter]
+        return params + list(self.custom_parameters)
+
+    ## Same call shape as pyshark's LiveCapture.sniff_continuously; runs until tshark exits or the capture is closed
+    def sniff_continuously(self, packet_count=None):
+        self.proc = subprocess.Popen(self.get_parameters(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger.debug(f'started tshark field extraction (pid {self.proc.pid})')
+        count = 0
+        for line in self.proc.stdout:
+            ## Skip the bulk-index lines '-T ek' writes between packets
+            if b'"layers"' not in line:
+                continue
+            try:
+                packet = self.packet_from_ek(json.loads(line)['layers'])
+            except (ValueError, KeyError, IndexError) as e:
+                self.errors += 1
+                logger.debug(f'error decoding tshark field output: {e}')
+                continue
+            if packet is None:
+                continue
+            self.packets += 1
+            yield packet
+            count += 1
+            if packet_count is not None and count >= packet_count:
+                break
+        self._check_exit()
+
+    def __iter__(self):
+        return self.sniff_continuously()
+
+    def _check_exit(self):
+        proc = self.proc
+        if proc is None or proc.poll() is None:
+            return
+        message = proc.stderr.read().decode('utf-8', 'replace').strip()
+        self.drops = buffer_drops(message) or self.drops
+        if proc.returncode != 0:
+            raise RuntimeError(f'tshark exited with {proc.returncode}: {message}')
+
+    def close(self):
+        with self.close_lock:
+            if self.proc is None:
+                return
+            if self.proc.poll() is None:
+                self.proc.terminate()
+                try:
+                    self.proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.proc.kill()
+            ## tshark prints its drop summary as it exits on SIGTERM; a killed one leaves no summary to read
+            if self.proc.returncode is not None:
+                self.drops = buffer_drops(self.proc.stderr.read()) or self.drops
+            self.proc = None
+
+    @staticmethod
+    def packet_from_ek(ek_layers):
+        values = {ek_fields[name]: value if isinstance(value, list) else [value] for name, value in ek_layers.items() if name in ek_fields}
+        if 'frame.protocols' not in values:
+            return None
+        return fieldcapture.packet_from_fields(values.pop('frame.protocols')[0].split(':'), values)
+
+    ## Rebuild the layer / field structure pyshark's JSON packets give the parser callbacks from the
+    ## protocol stack and {field: [value per occurrence]}
+    @staticmethod
+    def packet_from_fields(protocols, values):
+        ## Field prefix -> layer it belongs to in pyshark: SSDP is dissected by HTTP, and mDNS carries dns.* fields
+        owners = {'dns': 'mdns', 'http': 'ssdp' if 'ssdp' in protocols else 'http'}
+        by_layer = {}
+        for name, value in values.items():
+            prefix = name.split('.', 1)[0]
+            by_layer.setdefault(owners.get(prefix, prefix), {})[name] = value
+
+        layers = []
+        for layer_name in dict.fromkeys(protocols):
+            layer_fields = by_layer.get(layer_name, {})
+            occurrences = protocols.count(layer_name)
+            if occurrences > 1:
+                ## Encapsulated copies (ERSPAN / CAPWAP inner eth and ip) become duplicate_layers, one value each
+                layer = fieldlayer(layer_name, {name: value[0] for name, value in layer_fields.items() if value})
+                layer.duplicate_layers = [fieldlayer(layer_name, {name: value[i] for name, value in layer_fields.items() if len(value) > i})
+                                          for i in range(1, occurrences)]
+            else:
+                flat = {name: value[0] if len(value) == 1 else value for name, value in layer_fields.items()}
+                if layer_name == 'mdns':
+                    flat = fieldcapture.mdns_fields(layer_fields, flat)
+                layer = fieldlayer(layer_name, flat)
+            layers.append(layer)
+        if 'xml' in protocols and 'http.file_data' in values:
+            layers.append(fieldlayer('xml_raw', {}, value=fieldcapture.xml_hex(values['http.file_data'][0])))
+        return fieldpacket(protocols, layers)
+
+    ## Group the flattened dns.resp.* values into the per-section record dicts of pyshark's mDNS layer
+    @staticmethod
+    def mdns_fields(layer_fields, flat):
+        txts = layer_fields.get('dns.txt', [])
+        txt_lengths = layer_fields.get('dns.txt.length', [])
+        records = []
+        txt_index = 0
+        for name, record_type, length in zip(layer_fields.get('dns.resp.name', []), layer_fields.get('dns.resp.type', []), layer_fields.get('dns.resp.len', [])):
+            record = {'dns.resp.name': name, 'dns.resp.type': record_type}
+            if record_type == '16':
+                ## A TXT record's strings fill its data length, each with a one byte length prefix
+                strings = []
+                consumed = 0
+                while consumed < int(length) and txt_index < len(txts):
+                    strings.append(txts[txt_index])
+                    consumed += int(txt_lengths[txt_index]) + 1 if txt_index < len(txt_lengths) else int(length)
+                    txt_index += 1
+                if strings:
+                    record['dns.txt'] = strings[0] if len(strings) == 1 else strings
+            records.append((f'{name}: type {record_types.get(record_type, record_type)}, class IN', record))
+        start = 0
+        for section, count_field in mdns_sections:
+            count = int(flat.get(count_field, 0))
+            if count:
+                section_records = {}
+                for key, record in records[start:start + count]:
+                    ## Repeated record summaries collapse into a list, as pyshark's duplicate key handling does
+                    existing = section_records.get(key)
+                    if existing is None:
+                        section_records[key] = record
+                    elif isinstance(existing, list):
+                        existing.append(record)
+                    else:
+                        section_records[key] = [existing, record]
+                flat[section] = section_records
+            start += count
+        return flat
+
+    ## pyshark exposes the XML body as hex (xml_raw); tshark gives http.file_data as hex bytes or, on older versions, text
+    @staticmethod
+    def xml_hex(file_data):
+        if file_data.lstrip().startswith('<'):
+            return binascii.hexlify(file_data.encode('utf-8')).decode('ascii')
+        return file_data.replace(':', '')
+
+    def stats(self):
+        return {'packets': self.packets, 'errors': self.errors}
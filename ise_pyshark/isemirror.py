@@ -0,0 +1,81 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class isemirror:
+    ## Returned by get() for MACs the mirror has no record of (caller falls back to a per-MAC GET)
+    missing = object()
+
+    def __init__(self, ise_apis, page_size=100, refresh_interval=3600, filters=None):
+        self.ise_apis = ise_apis
+        self.page_size = page_size
+        self.refresh_interval = refresh_interval
+        self.filters = filters
+        ## mac (lowercase) -> custom attributes in the form returned by apis.get_ise_endpoint_async
+        self.entries = {}
+        self.loaded_at = None
+        self.task = None
+        ## Writes applied while a reload is in flight; re-applied on top of the reloaded pages
+        self.applied = {}
+        self.hits = 0
+        self.misses = 0
+        self.pages = 0
+
+    ## Page through ISE endpoints and replace the mirror; the previous mirror is kept if any page fails
+    ## NOTE: always a full reload - the endpoint list API offers no last-modified filter to fetch only changed endpoints,
+    ## so endpoints changed by other ISE clients stay stale until the next reload (see refresh_interval)
+    async def load(self):
+        start_time = time.time()
+        self.applied = {}
+        entries = {}
+        page = 1
+        while True:
+            endpoints = await self.ise_apis.get_ise_endpoints_page_async(page, self.page_size, self.filters)
+            if endpoints is None:
+                logger.warning(f'ISE endpoint mirror refresh failed on page {page} - keeping {len(self.entries)} mirrored endpoints')
+                return False
+            self.pages += 1
+            for endpoint in endpoints:
+                mac = endpoint.get('mac')
+                if mac:
+                    custom_attributes = endpoint.get('customAttributes')
+                    entries[mac.lower()] = "no_values" if custom_attributes is None else custom_attributes
+            if len(endpoints) < self.page_size:
+                break
+            page += 1
+        entries.update(self.applied)
+        self.entries = entries
+        self.applied = {}
+        self.loaded_at = time.time()
+        logger.info(f'ISE endpoint mirror loaded: {len(entries)} endpoints in {page} pages - {round(self.loaded_at - start_time,4)}sec')
+        return True
+
+    ## Start a background reload once 'refresh_interval' has passed; lookups keep using the current mirror meanwhile
+    def refresh(self):
+        if self.task is not None and not self.task.done():
+            return
+        if self.loaded_at is not None and time.time() - self.loaded_at < self.refresh_interval:
+            return
+        self.task = asyncio.ensure_future(self.load())
+
+    ## Return the mirrored custom attributes for 'mac', or isemirror.missing if ISE had no such endpoint at the last load
+    def get(self, mac):
+        result = self.entries.get(mac.lower(), self.missing)
+        if result is self.missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    ## Record bulk create / update payloads acknowledged by ISE so the next cycle diffs against them
+    def apply(self, updates):
+        for update in updates:
+            mac = update['mac'].lower()
+            self.entries[mac] = dict(update['customAttributes'])
+            if self.task is not None and not self.task.done():
+                self.applied[mac] = self.entries[mac]
+
+    def stats(self):
+        return {'endpoints': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'pages': self.pages}
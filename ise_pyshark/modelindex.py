@@ -0,0 +1,57 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+## Trie node key marking the end of a vendor name
+terminal = None
+## Upper bound on memoized vendor strings before the cache is reset
+vendor_cache_size = 4096
+
+class modelindex:
+    def __init__(self, models):
+        ## Exact-match model tables per vendor, as listed in models.json
+        self.models = {vendor: dict(entries) for vendor, entries in models.items()}
+        ## Case-insensitive prefix trie of vendor names; terminal nodes hold (models.json order, vendor)
+        self.trie = {}
+        for order, vendor in enumerate(models):
+            node = self.trie
+            for char in vendor.lower():
+                node = node.setdefault(char, {})
+            node.setdefault(terminal, []).append((order, vendor))
+        ## OUI vendor strings repeat for every packet from a device, so remember their trie matches
+        self.vendor_cache = {}
+        logger.debug(f'model index built: {len(self.models)} vendors, {sum(len(v) for v in self.models.values())} models')
+
+    ## Return the model record for an exact vendor / model pair
+    def vendor_model(self, vendor, model):
+        table = self.models.get(vendor)
+        if table is None:
+            return None
+        return table.get(model)
+
+    ## Return every vendor whose name is a case-insensitive prefix of 'vendor_string', in models.json order
+    def matching_vendors(self, vendor_string):
+        cached = self.vendor_cache.get(vendor_string)
+        if cached is not None:
+            return cached
+        node = self.trie
+        matches = list(node.get(terminal, ()))
+        for char in vendor_string.lower():
+            node = node.get(char)
+            if node is None:
+                break
+            matches.extend(node.get(terminal, ()))
+        matches.sort()
+        matches = tuple(vendor for order, vendor in matches)
+        if len(self.vendor_cache) >= vendor_cache_size:
+            self.vendor_cache.clear()
+        self.vendor_cache[vendor_string] = matches
+        return matches
+
+    ## Return the first model record (by models.json vendor order) matching the OUI vendor string and model text
+    def lookup(self, vendor_string, model):
+        for vendor in self.matching_vendors(vendor_string):
+            table = self.models[vendor]
+            if model in table:
+                return table[model]
+        return None
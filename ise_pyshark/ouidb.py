@@ -1,43 +1,98 @@
 import requests
+import array
 import csv
 import re
 import sqlite3
 import logging
-import pkg_resources
+import marshal
+import sys
+import os
 
 logger = logging.getLogger(__name__)
 
+## Version of the binary OUI index layout; bump when the structure written by build_index() changes
+index_version = 1
+## Supported IEEE assignment sizes (MA-S, MA-M, MA-L), most specific first
+prefix_bits = (36, 28, 24)
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
 class ouidb:
-    def __init__(self, url, raw_data_file, pipe_file, database_file):
+    def __init__(self, url, raw_data_file, pipe_file, database_file, index_file='db/macoui.bin'):
         self.url = url
-        self.raw_data_file = pkg_resources.resource_filename('ise_pyshark', raw_data_file)
-        self.pipe_file = pkg_resources.resource_filename('ise_pyshark', pipe_file)
-        self.database_file = pkg_resources.resource_filename('ise_pyshark', database_file)
-        # self._initialize_database()
+        self.raw_data_file = os.path.join(package_dir, raw_data_file)
+        self.pipe_file = os.path.join(package_dir, pipe_file)
+        self.database_file = os.path.join(package_dir, database_file)
+        self.index_file = os.path.join(package_dir, index_file)
+        self.oui_index = {bits: {} for bits in prefix_bits}
+        self.load_index()
 
-    def _initialize_database(self):
+    ## Rebuild the raw, pipe, sqlite and binary index files from the IEEE registries (see 'python -m ise_pyshark.ouidb')
+    def refresh(self):
         self.download_macoui_data()
         self.create_pipe_separated_file()
         self.import_to_sqlite()
+        self.build_index()
+        self.load_index()
 
+    ## Download the IEEE registries; 'url' may be a single URL or a list (MA-L, MA-M, MA-S), and entries may also be
+    ## paths to local copies of the registry text files
     def download_macoui_data(self):
         logger.debug('downloading OUI db - starting')
-        response = requests.get(self.url)
+        urls = [self.url] if isinstance(self.url, str) else self.url
+        contents = []
+        for url in urls:
+            if os.path.isfile(url):
+                with open(url, 'rb') as f:
+                    contents.append(f.read())
+                continue
+            response = requests.get(url, timeout=60)
+            response.raise_for_status()
+            contents.append(response.content)
+        ## Only replace the raw file once every registry was fetched
         with open(self.raw_data_file, 'wb') as f:
-            f.write(response.content)
+            for content in contents:
+                f.write(content)
+                f.write(b'\n')
         logger.debug('downloading OUI db - complete')
 
+    ## Convert IEEE registry text into 'OrgName|OUI' lines, where OUI is 6 (MA-L), 7 (MA-M) or 9 (MA-S) hex digits
     def create_pipe_separated_file(self):
         logger.debug('parsing OUI db data - starting')
         with open(self.raw_data_file, 'r') as infile, open(self.pipe_file, 'w') as outfile:
             outfile.write("OrgName|OUI\n")
+            pending = None                                  # (orgname, oui) from the last '(hex)' line
             for line in infile:
                 line = line.rstrip('\n')
-                if match := re.match(r'^([0-9A-F]{2})-([0-9A-F]{2})-([0-9A-F]{2})\s+\(hex\)\s+(.+)$', line):
-                    orgname, oui = match.group(4), match.group(1) + match.group(2) + match.group(3)
-                    outfile.write(f"{orgname}|{oui}\n")
+                if match := re.match(r'^\s*([0-9A-F]{2})-([0-9A-F]{2})-([0-9A-F]{2})\s+\(hex\)\s+(.+)$', line):
+                    if pending:
+                        outfile.write(f"{pending[0]}|{pending[1]}\n")
+                    pending = (match.group(4).strip(), match.group(1) + match.group(2) + match.group(3))
+                elif match := re.match(r'^\s*([0-9A-F]{6,12})-([0-9A-F]{6,12})\s+\(base 16\)\s+(.+)$', line):
+                    ## MA-M / MA-S blocks list the assigned range beneath the parent '(hex)' line
+                    if pending:
+                        low, high = match.group(1), match.group(2)
+                        if len(low) == 6:
+                            low, high = pending[1] + low, pending[1] + high
+                        prefix = self.range_to_prefix(low, high)
+                        if prefix:
+                            outfile.write(f"{match.group(3).strip()}|{prefix}\n")
+                        pending = None
+            if pending:
+                outfile.write(f"{pending[0]}|{pending[1]}\n")
         logger.debug('parsing OUI db data - complete')
 
+    ## Reduce an IEEE range (ex. 70B3D5E5F000-70B3D5E5FFFF) to its fixed prefix (ex. 70B3D5E5F)
+    @staticmethod
+    def range_to_prefix(low, high):
+        if len(low) != len(high):
+            return None
+        length = len(low)
+        while length > 0 and low[length - 1] == '0' and high[length - 1] == 'F':
+            length -= 1
+        if low[:length] != high[:length] or length * 4 not in prefix_bits:
+            return None
+        return low[:length]
+
     def import_to_sqlite(self):
         logger.debug('create OUI db table - starting')
         connection = sqlite3.connect(self.database_file)
@@ -69,17 +124,92 @@ class ouidb:
         connection.close()
         logger.debug('create OUI db table - complete')
 
-    def query_mac_address(self, mac_address):
+    ## Compile the OUI table into a packed binary index: vendor names plus per-prefix-size arrays of (prefix, name index)
+    def build_index(self):
+        logger.debug('building OUI index - starting')
+        index = {bits: {} for bits in prefix_bits}
+        names = {}
         connection = sqlite3.connect(self.database_file)
-        cursor = connection.cursor()
+        try:
+            for orgname, oui in connection.execute('SELECT OrgName, OUI FROM macoui'):
+                if not oui or len(oui) * 4 not in index:
+                    continue
+                try:
+                    prefix = int(oui, 16)
+                except ValueError:
+                    continue
+                index[len(oui) * 4].setdefault(prefix, names.setdefault(orgname, len(names)))
+        finally:
+            connection.close()
+        tables = {}
+        for bits, entries in index.items():
+            tables[bits] = (array.array('Q', entries.keys()).tobytes(), array.array('I', entries.values()).tobytes())
+        with open(self.index_file, 'wb') as f:
+            marshal.dump((index_version, sys.byteorder, '\n'.join(names), tables), f)
+        logger.debug(f'building OUI index - complete: {sum(len(v) for v in index.values())} entries')
 
-        # Query the OrgName for the given MAC address
-        cursor.execute('SELECT OrgName FROM macoui WHERE OUI = ?', (mac_address,))
-        result = cursor.fetchone()
-        connection.close()
+    ## Read the packed binary index into {prefix bits: {integer prefix: OrgName}}
+    def _read_index(self):
+        with open(self.index_file, 'rb') as f:
+            version, byteorder, names, tables = marshal.load(f)
+        if version != index_version:
+            raise ValueError(f'unsupported OUI index version {version}')
+        names = names.split('\n')
+        index = {}
+        for bits, (keys, values) in tables.items():
+            prefixes, positions = array.array('Q'), array.array('I')
+            prefixes.frombytes(keys)
+            positions.frombytes(values)
+            if byteorder != sys.byteorder:
+                prefixes.byteswap()
+                positions.byteswap()
+            index[bits] = dict(zip(prefixes, map(names.__getitem__, positions)))
+        return index
+
+    ## Load the prebuilt binary index, rebuilding it from the sqlite table if missing or out of date
+    def load_index(self):
+        logger.debug('loading OUI index - starting')
+        try:
+            index = self._read_index()
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logger.debug(f'OUI index unavailable ({e}) - rebuilding from {self.database_file}')
+            try:
+                self.build_index()
+                index = self._read_index()
+            except (OSError, EOFError, ValueError, TypeError, sqlite3.Error) as e:
+                logger.warning(f'unable to load OUI db - {e}')
+                index = {}
+        self.oui_index = {bits: index.get(bits, {}) for bits in prefix_bits}
+        logger.debug(f'loading OUI index - complete: {sum(len(v) for v in self.oui_index.values())} entries')
+
+    ## Return the most specific (MA-S, then MA-M, then MA-L) vendor for a full MAC address
+    def lookup_mac(self, mac):
+        digits = mac.replace(':', '').replace('-', '').replace('.', '')
+        if len(digits) < 9:
+            return self.query_mac_address(digits[:6].upper())
+        try:
+            value = int(digits[:9], 16)
+        except ValueError:
+            return None
+        return (self.oui_index[36].get(value)
+                or self.oui_index[28].get(value >> 8)
+                or self.oui_index[24].get(value >> 12))
+
+    def query_mac_address(self, mac_address):
+        # Query the OrgName for the given 6, 7 or 9 hex digit MAC address prefix from the in-memory index
+        table = self.oui_index.get(len(mac_address) * 4)
+        if table is None:
+            return None
+        try:
+            return table.get(int(mac_address, 16))
+        except ValueError:
+            return None
 
-        # Print the result
-        if result:
-            return result[0]
-        else:
-            return None
\ No newline at end of file
+if __name__ == '__main__':
+    ## Refresh the OUI data from the IEEE MA-L, MA-M and MA-S registries, or from local copies of them given as arguments
+    from ise_pyshark.parser import macoui_url, macoui_raw_data_file, macoui_pipe_file, macoui_database_file, macoui_index_file
+    logging.basicConfig(level=logging.DEBUG)
+    target = ouidb(sys.argv[1:] or macoui_url, macoui_raw_data_file, macoui_pipe_file, macoui_database_file, macoui_index_file)
+    target.refresh()
+    print(f'OUI index written to {target.index_file}: ' + ', '.join(f'{len(target.oui_index[bits])} {bits}-bit' for bits in prefix_bits) + ' prefixes')
+    sys.exit(0)
@@ -0,0 +1,97 @@
+import time
+import json
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+## Redis keys (kept in their own db so the collector's start-up flush of the local / remote caches leaves them intact)
+entries_key = 'outbox:entries'      ## mac -> JSON {action, update, row, created, attempts}
+due_key = 'outbox:due'              ## sorted set: mac scored by the time of its next send attempt
+
+class outbox:
+    def __init__(self, redis_db, max_age=3600, base_delay=30.0, max_delay=1800.0):
+        self.redis_db = redis_db
+        self.max_age = max_age
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queued = 0
+        self.acked = 0
+        self.retried = 0
+        self.expired = 0
+        pending = self.redis_db.hlen(entries_key)
+        if pending:
+            logger.warning(f'ISE outbox holds {pending} endpoint updates from a previous run')
+
+    ## Queue (action, update, row) tuples: 'update' is the ISE bulk payload entry, 'row' the remote cache record
+    ## committed once ISE acknowledges it. A newer entry for the same MAC replaces the pending payload but keeps its
+    ## age, attempt count and next attempt time, so an endpoint that keeps changing still backs off and expires.
+    def put(self, items):
+        if not items:
+            return
+        now = time.time()
+        macs = [update['mac'] for action, update, row in items]
+        pending = dict(zip(macs, self.redis_db.hmget(entries_key, macs)))
+        with self.redis_db.pipeline() as pipe:
+            for action, update, row in items:
+                existing = pending[update['mac']]
+                if existing is not None:
+                    entry = json.loads(existing)
+                    entry.update({'action': action, 'update': update, 'row': row})
+                else:
+                    entry = {'action': action, 'update': update, 'row': row, 'created': now, 'attempts': 0}
+                    pipe.zadd(due_key, {update['mac']: now})
+                pipe.hset(entries_key, update['mac'], json.dumps(entry))
+            pipe.execute()
+        self.queued += len(items)
+
+    ## Return the entries whose next attempt is due, grouped by action; entries older than 'max_age' are dropped
+    def due(self):
+        now = time.time()
+        macs = self.redis_db.zrangebyscore(due_key, '-inf', now)
+        grouped = {}
+        if not macs:
+            return grouped
+        expired = []
+        for mac, value in zip(macs, self.redis_db.hmget(entries_key, macs)):
+            if value is None:
+                expired.append(mac)
+                continue
+            entry = json.loads(value)
+            if now - entry['created'] > self.max_age:
+                logger.warning(f"dropping ISE {entry['action']} for {entry['update']['mac']} after {entry['attempts']} attempts - older than {self.max_age}sec")
+                expired.append(mac)
+                self.expired += 1
+                continue
+            grouped.setdefault(entry['action'], []).append(entry)
+        if expired:
+            self._remove(expired)
+        return grouped
+
+    ## ISE accepted these entries; remove them from the outbox
+    def ack(self, entries):
+        self._remove([entry['update']['mac'] for entry in entries])
+        self.acked += len(entries)
+
+    ## ISE did not accept these entries; schedule another attempt with exponential backoff and jitter
+    def retry(self, entries):
+        now = time.time()
+        with self.redis_db.pipeline() as pipe:
+            for entry in entries:
+                entry['attempts'] += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** (entry['attempts'] - 1))
+                delay *= random.uniform(0.5, 1.0)
+                pipe.hset(entries_key, entry['update']['mac'], json.dumps(entry))
+                pipe.zadd(due_key, {entry['update']['mac']: now + delay})
+            pipe.execute()
+        self.retried += len(entries)
+
+    def _remove(self, macs):
+        with self.redis_db.pipeline() as pipe:
+            pipe.hdel(entries_key, *macs)
+            pipe.zrem(due_key, *macs)
+            pipe.execute()
+
+    def stats(self):
+        return {'pending': self.redis_db.hlen(entries_key), 'queued': self.queued, 'acked': self.acked,
+                'retried': self.retried, 'expired': self.expired}
@@ -1,46 +1,56 @@
+import os
 import json
 import binascii
 import re
 import logging
-import pkg_resources
-from user_agents import parse
 import xml.etree.ElementTree as ET
 from .ouidb import *
+from .modelindex import modelindex
+from .uacache import uacache
+from .unknownmodels import unknownmodels
 
 apple_os_data, models_data, android_models = {}, {}, {}
+models_index = modelindex({})
 
-macoui_url = 'https://standards-oui.ieee.org/'
+macoui_url = ['https://standards-oui.ieee.org/',                     # MA-L (24-bit)
+              'https://standards-oui.ieee.org/oui28/mam.txt',       # MA-M (28-bit)
+              'https://standards-oui.ieee.org/oui36/oui36.txt']     # MA-S (36-bit)
 macoui_raw_data_file = 'db/macoui.txt'
 macoui_pipe_file = 'db/macoui.pipe'
 macoui_database_file = 'db/macoui.db'
-oui_manager = ouidb(macoui_url, macoui_raw_data_file, macoui_pipe_file, macoui_database_file)
+macoui_index_file = 'db/macoui.bin'
+## Fingerprint databases, relative to the package directory
+package_dir = os.path.dirname(os.path.abspath(__file__))
+apple_os_file = 'db/apple-os.json'
+models_file = 'db/models.json'
+android_file = 'db/androids.json'
+oui_manager = ouidb(macoui_url, macoui_raw_data_file, macoui_pipe_file, macoui_database_file, macoui_index_file)
 
 logger = logging.getLogger(__name__)
 
 ## TODO - create documentation on specific weighting of attributes from various protocols 
 
 class parser:
-    def __init__(self):
-        self.apple_os_json = pkg_resources.resource_filename('ise_pyshark','db/apple-os.json')
-        self.models_json = pkg_resources.resource_filename('ise_pyshark','db/models.json')
-        self.android_json = pkg_resources.resource_filename('ise_pyshark','db/androids.json')
+    def __init__(self, ua_cache_size=1024):
+        ## The same few hundred User-Agent strings repeat constantly, so cache their parsed values
+        self.ua_cache = uacache(ua_cache_size)
+        ## Unknown models are indexed in memory and written to disk in batches by a background thread
+        self.unknown_models = unknownmodels('unknown_models.txt')
         self._initialize_database()
     
     def _initialize_database(self):
-        global apple_os_data, models_data, android_models
-        with open(self.apple_os_json, 'r') as file:
-            json_data = file.read()
-        apple_os_data = json.loads(json_data)
-        with open(self.models_json, 'r') as file:
-            json_data = file.read()
-        models_data = json.loads(json_data)
-        with open(self.android_json, 'r') as file:
-            json_data = file.read()
-        android_models = json.loads(json_data)
+        global apple_os_data, models_data, android_models, models_index
+        with open(os.path.join(package_dir, apple_os_file), 'rb') as file:
+            apple_os_data = json.load(file)
+        with open(os.path.join(package_dir, models_file), 'rb') as file:
+            models_data = json.load(file)
+        with open(os.path.join(package_dir, android_file), 'rb') as file:
+            android_models = json.load(file)
+        models_index = modelindex(models_data)
 
     def get_OUI(self, mac, manager):
-        mac_prefix = mac.replace(':','')[:6].upper()
-        vendor = manager.query_mac_address(mac_prefix)
+        ## Longest-prefix match across MA-S, MA-M and MA-L assignments
+        vendor = manager.lookup_mac(mac.upper())
         ## IF NO MATCH FOUND, CHECK IF MAC ADDRESS FOLLOWS RANDOMIZATION STANDARD
         if vendor is None:
             pattern = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
@@ -81,13 +91,12 @@ class parser:
                 else:
                     values[8] = txt[model_index:]
                 ## Parse through model details of Apple devices only
-                for model, result in models_data['Apple'].items():
-                    if values[8] == model:
-                        model_match = True
-                        values[6] = result['name']
-                        values[10] = result['type']
-                        values[14], values[16], values[18] = 80, 80, 80
-                        break
+                result = models_index.vendor_model('Apple', values[8])
+                if result is not None:
+                    model_match = True
+                    values[6] = result['name']
+                    values[10] = result['type']
+                    values[14], values[16], values[18] = 80, 80, 80
             return values
         
         if 'usb_MDL=' in txt:
@@ -113,43 +122,23 @@ class parser:
                 values[8] = match.group(1)
 
         ## TODO Modify functionality to remove prefix= and instead search raw text values
-        ## Look through models dict, first by OUI details
-        for oui, models in models_data.items():
-            if values[5].lower().startswith(oui.lower()):
-                ## If there is an OUI match, search through the models provided
-                for model, result in models.items():
-                    ## If model match found, record details of HW model and improve certainty
-                    if txt == model:
-                        model_match = True
-                        values[6] = result['name']
-                        values[10] = result['type']
-                        values[14], values[16], values[18] = 80, 80, 80
-                        break               ## Exit for loop through models
-            if model_match is True:
-                break                       ## Exit for loop through OUIs
+        ## Look up the model under every models.json vendor that prefixes the OUI vendor name
+        result = models_index.lookup(values[5], txt)
+        ## If model match found, record details of HW model and improve certainty
+        if result is not None:
+            model_match = True
+            values[6] = result['name']
+            values[10] = result['type']
+            values[14], values[16], values[18] = 80, 80, 80
         ## If model data doesn't match any record, record model data and use lower certainty
         if model_match is not True:
             values[16] = 35
             self.record_unknown_model(values)
         return values
 
-    ## If no model is found, record to local TXT file
+    ## If no model is found, record to local TXT file (with occurrence count and first/last seen times)
     def record_unknown_model(self, values):
-        record = values[0] + ' | ' + values[1] + ' | ' + values[2] + ' | ' + values[5] + ' | ' + values[8]
-        try:
-            with open('unknown_models.txt', 'r') as file:
-                lines = file.readlines()
-                # Remove newline characters for comparison
-                lines = [l.strip() for l in lines]
-        except FileNotFoundError:
-            # If the file doesn't exist, consider it as an empty file
-            lines = []
-
-        # Check if the line already exists
-        if record.strip() not in lines:
-            with open('unknown_models.txt', 'a') as file:
-                file.write(record + '\n')
-            logger.info(f"Unknown model recorded: {record}")
+        self.unknown_models.record(values)
 
     def parse_mac_ip(self, packet):
         try:
@@ -204,20 +193,20 @@ class parser:
 
             if 'user_agent' in layer.field_names:
                 ua_string = layer.user_agent
-                user_agent = parse(ua_string)
+                user_agent = self.ua_cache.get(ua_string)
                 model_match = False
-                if user_agent.os.family == 'Other' and 'Mac OS X' in ua_string:
+                if user_agent.os_family == 'Other' and 'Mac OS X' in ua_string:
                     asset_values[7] = 'Mac OS X'
                     asset_values[15] = 10
-                elif user_agent.os.family != '':
-                    asset_values[7] = user_agent.os.family
+                elif user_agent.os_family != '':
+                    asset_values[7] = user_agent.os_family
                     asset_values[15] = 10           #Weak score as often just generic OS type 'Windows'
-                if user_agent.os.version_string != '':
-                    asset_values[7] = user_agent.os.family + ' ' + user_agent.os.version_string
+                if user_agent.os_version != '':
+                    asset_values[7] = user_agent.os_family + ' ' + user_agent.os_version
                     asset_values[15] = 30           # Still a weak score because OS details can be inaccurate (ex. 'OS X 10.15' reported on Mac running 14.2)
-                if user_agent.device.brand is not None and user_agent.device.brand != 'Other':
-                    if user_agent.device.model is not None and user_agent.device.model != '' and user_agent.device.model != 'User-Agent':
-                        asset_values[8] = user_agent.device.model
+                if user_agent.brand is not None and user_agent.brand != 'Other':
+                    if user_agent.model is not None and user_agent.model != '' and user_agent.model != 'User-Agent':
+                        asset_values[8] = user_agent.model
                         asset_values[16] = 50
                         if 'Android' in asset_values[7]:
                             # Check if the user-agent includes a Samsung format (ex. SM-x123)
@@ -287,19 +276,19 @@ class parser:
 
             if 'user_agent' in layer.field_names:
                 ua_string = layer.user_agent
-                user_agent = parse(ua_string)
-                if user_agent.os.family == 'Other' and 'Mac OS X' in ua_string:
+                user_agent = self.ua_cache.get(ua_string)
+                if user_agent.os_family == 'Other' and 'Mac OS X' in ua_string:
                     asset_values[7] = 'Mac OS X'
                     asset_values[15] = 10
-                elif user_agent.os.family != '':
-                    asset_values[7] = user_agent.os.family
+                elif user_agent.os_family != '':
+                    asset_values[7] = user_agent.os_family
                     asset_values[15] = 10           #Weak score as often just generic OS type 'Windows'
-                if user_agent.os.version_string != '':
-                    asset_values[7] = user_agent.os.family + ' ' + user_agent.os.version_string
+                if user_agent.os_version != '':
+                    asset_values[7] = user_agent.os_family + ' ' + user_agent.os_version
                     asset_values[15] = 50
-                if user_agent.device.brand is not None and user_agent.device.brand != 'Other':
-                    if user_agent.device.model is not None and user_agent.device.model != '':
-                        asset_values[8] = user_agent.device.model
+                if user_agent.brand is not None and user_agent.brand != 'Other':
+                    if user_agent.model is not None and user_agent.model != '':
+                        asset_values[8] = user_agent.model
                         asset_values[16] = 30               
                 if int(asset_values[18]) > 30:
                     if user_agent.is_pc is True:
@@ -0,0 +1,422 @@
+import shutil
+import struct
+import logging
+import socket
+import threading
+import subprocess
+from .fieldcapture import fieldcapture
+from .capturestats import buffer_drops
+
+logger = logging.getLogger(__name__)
+
+## UDP ports decoded in-process; everything else is left to tshark
+mdns_port = 5353
+ssdp_port = 1900
+nbdgm_port = 138
+capwap_data_port = 5247
+native_ports = (mdns_port, ssdp_port, nbdgm_port)
+
+linktype_ethernet = 1
+pcap_magic = {b'\xd4\xc3\xb2\xa1': '<', b'\xa1\xb2\xc3\xd4': '>', b'\x4d\x3c\xb2\xa1': '<', b'\xa1\xb2\x3c\x4d': '>'}
+pcapng_magic = b'\x0a\x0d\x0d\x0a'
+
+class decode_error(ValueError):
+    pass
+
+class rawcapture:
+    def __init__(self, interface=None, input_file=None, bpf_filter=None, mdns_types=None, swap_frame_control=True, dumpcap_path=None):
+        self.interface = interface
+        self.input_file = input_file
+        self.bpf_filter = bpf_filter
+        ## Only yield mDNS packets carrying one of these record types (as the ise-pyshark-file display filter does); None for all
+        self.mdns_types = mdns_types
+        ## Cisco APs send the 802.11 frame control field byte-swapped in CAPWAP (Wireshark's capwap 'swap frame control' default)
+        self.swap_frame_control = swap_frame_control
+        self.dumpcap_path = dumpcap_path or shutil.which('dumpcap') or 'dumpcap'
+        self.proc = None
+        ## Capture buffer drops dumpcap reported on stderr when it last exited (see capturestats.buffer_drops)
+        self.drops = None
+        ## close() runs from both the capture thread and shutdown; only one of them may reap dumpcap and read its summary
+        self.close_lock = threading.Lock()
+        self.frames = 0
+        self.packets = 0
+        self.errors = 0
+
+    ## Live frames come from dumpcap as a classic pcap stream on stdout, so the BPF filter still runs in the kernel
+    def get_parameters(self):
+        params = [self.dumpcap_path, '-q', '-i', self.interface, '-w', '-', '-F', 'pcap']
+        if self.bpf_filter:
+            params += ['-f', self.bpf_filter]
+        return params
+
+    ## Same call shape as pyshark's LiveCapture.sniff_continuously; runs until dumpcap exits or the capture is closed
+    def sniff_continuously(self, packet_count=None):
+        if self.input_file:
+            stream = open(self.input_file, 'rb')
+        else:
+            self.proc = subprocess.Popen(self.get_parameters(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            logger.debug(f'started dumpcap for native decoding (pid {self.proc.pid})')
+            stream = self.proc.stdout
+        count = 0
+        try:
+            for linktype, frame in self.read_frames(stream):
+                self.frames += 1
+                if linktype != linktype_ethernet:
+                    continue
+                try:
+                    packet = self.decode(frame)
+                except (decode_error, struct.error, IndexError, UnicodeDecodeError) as e:
+                    self.errors += 1
+                    logger.debug(f'error decoding packet {self.frames}: {e}')
+                    continue
+                if packet is None:
+                    continue
+                self.packets += 1
+                yield packet
+                count += 1
+                if packet_count is not None and count >= packet_count:
+                    break
+        finally:
+            if self.input_file:
+                stream.close()
+        self._check_exit()
+
+    def __iter__(self):
+        return self.sniff_continuously()
+
+    def _check_exit(self):
+        proc = self.proc
+        if proc is None or proc.poll() is None:
+            return
+        message = proc.stderr.read().decode('utf-8', 'replace').strip()
+        self.drops = buffer_drops(message) or self.drops
+        if proc.returncode != 0:
+            raise RuntimeError(f'dumpcap exited with {proc.returncode}: {message}')
+
+    def close(self):
+        with self.close_lock:
+            if self.proc is None:
+                return
+            if self.proc.poll() is None:
+                self.proc.terminate()
+                try:
+                    self.proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.proc.kill()
+            ## dumpcap prints its drop summary as it exits on SIGTERM; a killed one leaves no summary to read
+            if self.proc.returncode is not None:
+                self.drops = buffer_drops(self.proc.stderr.read()) or self.drops
+            self.proc = None
+
+    def stats(self):
+        return {'frames': self.frames, 'packets': self.packets, 'errors': self.errors}
+
+    ## Yield (linktype, frame bytes) from a pcap or pcapng stream
+    @staticmethod
+    def read_frames(stream):
+        magic = stream.read(4)
+        if magic in pcap_magic:
+            endian = pcap_magic[magic]
+            header = stream.read(20)
+            linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0x0fffffff
+            while True:
+                record = stream.read(16)
+                if len(record) < 16:
+                    return
+                caplen = struct.unpack(endian + 'IIII', record)[2]
+                frame = stream.read(caplen)
+                if len(frame) < caplen:
+                    return
+                yield linktype, frame
+        elif magic == pcapng_magic:
+            yield from rawcapture._read_pcapng(stream, magic)
+        elif magic:
+            raise decode_error('not a pcap or pcapng capture')
+
+    @staticmethod
+    def _read_pcapng(stream, block_type):
+        endian = '<'
+        linktypes = []
+        while True:
+            if block_type is None:
+                block_type = stream.read(4)
+            if len(block_type) < 4:
+                return
+            length_bytes = stream.read(4)
+            if len(length_bytes) < 4:
+                return
+            if block_type == pcapng_magic:
+                ## Section header: the byte-order magic decides the endianness of everything in the section
+                body = stream.read(4)
+                endian = '<' if body == b'\x4d\x3c\x2b\x1a' else '>'
+                length = struct.unpack(endian + 'I', length_bytes)[0]
+                stream.read(length - 12)
+                linktypes = []
+                block_type = None
+                continue
+            length = struct.unpack(endian + 'I', length_bytes)[0]
+            body = stream.read(length - 8)
+            if len(body) < length - 8:
+                return
+            number = struct.unpack(endian + 'I', block_type)[0]
+            if number == 1:                 ## Interface description
+                linktypes.append(struct.unpack(endian + 'H', body[:2])[0])
+            elif number == 6:               ## Enhanced packet
+                interface, caplen = struct.unpack(endian + 'I', body[:4])[0], struct.unpack(endian + 'I', body[12:16])[0]
+                yield linktypes[interface] if interface < len(linktypes) else linktype_ethernet, body[20:20 + caplen]
+            elif number == 3:               ## Simple packet
+                length = struct.unpack(endian + 'I', body[:4])[0]
+                yield linktypes[0] if linktypes else linktype_ethernet, body[4:min(len(body) - 4, 4 + length)]
+            block_type = None
+
+    ## Decode one Ethernet frame into a pyshark-compatible packet, or None if it is not an mDNS, SSDP or browser packet
+    def decode(self, frame):
+        protocols = []
+        values = {}
+        offset = self._ethernet(frame, 0, protocols, values)
+        if offset is None:
+            return None
+        ip_proto, offset, end = self._ipv4(frame, offset, protocols, values)
+        if ip_proto == 47:
+            ## ERSPAN: mirror traffic wrapped in GRE, inner Ethernet frame follows the ERSPAN header
+            offset = self._erspan(frame, offset, end, protocols)
+            if offset is None:
+                return None
+            offset = self._ethernet(frame, offset, protocols, values)
+            if offset is None:
+                return None
+            ip_proto, offset, end = self._ipv4(frame, offset, protocols, values)
+        if ip_proto != 17:
+            return None
+        sport, dport, offset, end = self._udp(frame, offset, end, protocols)
+        if capwap_data_port in (sport, dport):
+            offset = self._capwap(frame, offset, end, protocols, values)
+            if offset is None:
+                return None
+            ip_proto, offset, end = self._ipv4(frame, offset, protocols, values)
+            if ip_proto != 17:
+                return None
+            sport, dport, offset, end = self._udp(frame, offset, end, protocols)
+        payload = frame[offset:end]
+        if mdns_port in (sport, dport):
+            if not self._mdns(payload, protocols, values):
+                return None
+        elif ssdp_port in (sport, dport):
+            if not self._ssdp(payload, protocols, values):
+                return None
+        elif nbdgm_port in (sport, dport):
+            if not self._browser(payload, protocols, values):
+                return None
+        else:
+            return None
+        return fieldcapture.packet_from_fields(protocols, values)
+
+    @staticmethod
+    def _mac(data):
+        return ':'.join('%02x' % octet for octet in data)
+
+    def _ethernet(self, frame, offset, protocols, values):
+        if len(frame) < offset + 14:
+            raise decode_error('short Ethernet header')
+        values.setdefault('eth.src', []).append(self._mac(frame[offset + 6:offset + 12]))
+        ethertype = struct.unpack_from('!H', frame, offset + 12)[0]
+        offset += 14
+        protocols += ['eth', 'ethertype']
+        while ethertype in (0x8100, 0x88a8):
+            ethertype = struct.unpack_from('!H', frame, offset + 2)[0]
+            offset += 4
+            protocols += ['vlan', 'ethertype']
+        return offset if ethertype == 0x0800 else None
+
+    def _ipv4(self, frame, offset, protocols, values):
+        if len(frame) < offset + 20:
+            raise decode_error('short IPv4 header')
+        version_ihl, total_length = frame[offset], struct.unpack_from('!H', frame, offset + 2)[0]
+        if version_ihl >> 4 != 4:
+            raise decode_error('not IPv4')
+        flags_fragment = struct.unpack_from('!H', frame, offset + 6)[0]
+        ## Fragments would need reassembly; leave them (rare for these protocols) to tshark
+        if flags_fragment & 0x3fff:
+            return None, offset, offset
+        values.setdefault('ip.src', []).append(socket.inet_ntoa(frame[offset + 12:offset + 16]))
+        protocols.append('ip')
+        return frame[offset + 9], offset + (version_ihl & 0x0f) * 4, min(len(frame), offset + total_length)
+
+    def _udp(self, frame, offset, end, protocols):
+        sport, dport, length = struct.unpack_from('!HHH', frame, offset)
+        protocols.append('udp')
+        return sport, dport, offset + 8, min(end, offset + length)
+
+    def _erspan(self, frame, offset, end, protocols):
+        flags, protocol = struct.unpack_from('!HH', frame, offset)
+        offset += 4
+        ## Optional checksum, key and sequence number words
+        offset += 4 * bool(flags & 0x8000) + 4 * bool(flags & 0x2000) + 4 * bool(flags & 0x1000)
+        protocols.append('gre')
+        if protocol == 0x88be:
+            ## Type II carries an 8 byte header; type I (no sequence number) has none
+            if flags & 0x1000:
+                offset += 8
+        elif protocol == 0x22eb:
+            ## Type III: 12 byte header plus an 8 byte platform sub-header when the O flag is set
+            offset += 12 + 8 * (frame[offset + 11] & 0x01)
+        else:
+            return None
+        protocols.append('erspan')
+        return offset if offset < end else None
+
+    def _capwap(self, frame, offset, end, protocols, values):
+        preamble = frame[offset]
+        ## Type 1 is a DTLS-encrypted payload
+        if preamble & 0x0f:
+            return None
+        header_length, wbid_flags = (frame[offset + 1] >> 3) * 4, struct.unpack_from('!H', frame, offset + 2)[0]
+        protocols.append('capwap.data')
+        offset += header_length
+        ## T flag clear: an 802.3 frame follows instead of a native 802.11 one
+        if not wbid_flags & 0x0100:
+            return self._ethernet(frame, offset, protocols, values)
+        frame_control = frame[offset:offset + 2]
+        if self.swap_frame_control:
+            frame_control = frame_control[::-1]
+        subtype_type, ds = frame_control[0], frame_control[1] & 0x03
+        if (subtype_type >> 2) & 0x03 != 2:
+            return None
+        addresses = [frame[offset + start:offset + start + 6] for start in (4, 10, 16)]
+        header = 24
+        if ds == 3:
+            addresses.append(frame[offset + 24:offset + 30])
+            header += 6
+        ## QoS data subtypes carry two more bytes, plus an HT control field when the order bit is set
+        if subtype_type & 0x80:
+            header += 2 + 4 * bool(frame_control[1] & 0x80)
+        ## Source address by DS bits: none / to-DS = addr2, from-DS = addr3, both = addr4
+        source = addresses[{0: 1, 1: 1, 2: 2, 3: 3}[ds]]
+        values.setdefault('wlan.sa', []).append(self._mac(source))
+        protocols.append('wlan')
+        offset += header
+        if frame[offset:offset + 6] != b'\xaa\xaa\x03\x00\x00\x00' or struct.unpack_from('!H', frame, offset + 6)[0] != 0x0800:
+            return None
+        protocols.append('llc')
+        return offset + 8
+
+    ## DNS name at 'offset' (following compression pointers); returns (name, offset after the name)
+    @staticmethod
+    def _dns_name(payload, offset):
+        labels = []
+        end = None
+        jumps = 0
+        while True:
+            length = payload[offset]
+            if length & 0xc0 == 0xc0:
+                if end is None:
+                    end = offset + 2
+                jumps += 1
+                if jumps > 32:
+                    raise decode_error('DNS name compression loop')
+                offset = struct.unpack_from('!H', payload, offset)[0] & 0x3fff
+                continue
+            offset += 1
+            if length == 0:
+                break
+            labels.append(payload[offset:offset + length].decode('utf-8', 'replace'))
+            offset += length
+        return '.'.join(labels) if labels else '<Root>', end if end is not None else offset
+
+    def _mdns(self, payload, protocols, values):
+        if len(payload) < 12:
+            raise decode_error('short DNS header')
+        questions, answers, auth_rrs, add_rrs = struct.unpack_from('!HHHH', payload, 4)
+        offset = 12
+        for _ in range(questions):
+            offset = self._dns_name(payload, offset)[1] + 4
+        names, types, lengths, txts, txt_lengths = [], [], [], [], []
+        for _ in range(answers + auth_rrs + add_rrs):
+            name, offset = self._dns_name(payload, offset)
+            record_type, record_class, ttl, length = struct.unpack_from('!HHIH', payload, offset)
+            offset += 10
+            if offset + length > len(payload):
+                raise decode_error('truncated DNS record')
+            names.append(name)
+            types.append(str(record_type))
+            lengths.append(str(length))
+            if record_type == 16:
+                position = offset
+                while position < offset + length:
+                    string_length = payload[position]
+                    txts.append(payload[position + 1:position + 1 + string_length].decode('utf-8', 'replace'))
+                    txt_lengths.append(str(string_length))
+                    position += 1 + string_length
+            offset += length
+        if self.mdns_types is not None and not any(record_type in self.mdns_types for record_type in types):
+            return False
+        values.update({'dns.count.answers': [str(answers)], 'dns.count.auth_rr': [str(auth_rrs)], 'dns.count.add_rr': [str(add_rrs)],
+                       'dns.resp.name': names, 'dns.resp.type': types, 'dns.resp.len': lengths,
+                       'dns.txt': txts, 'dns.txt.length': txt_lengths})
+        protocols.append('mdns')
+        return True
+
+    def _ssdp(self, payload, protocols, values):
+        lines = payload.decode('utf-8', 'replace').split('\r\n')
+        ## Only HTTP-formed messages (NOTIFY / M-SEARCH requests and their responses) are dissected as SSDP
+        if ' HTTP/1.' not in lines[0] and not lines[0].startswith('HTTP/1.'):
+            return False
+        for line in lines[1:]:
+            if not line:
+                break
+            name, separator, value = line.partition(':')
+            if separator and name.strip().lower() == 'user-agent':
+                values['http.user_agent'] = [value.strip()]
+                break
+        protocols.append('ssdp')
+        return True
+
+    ## NetBIOS first-level encoded name: 32 'A'-based nibble characters -> 'NAME<suffix>'
+    @staticmethod
+    def _netbios_name(payload, offset):
+        length = payload[offset]
+        if length != 32:
+            raise decode_error('unexpected NetBIOS name length')
+        encoded = payload[offset + 1:offset + 33]
+        if len(encoded) != 32 or any(not 0x41 <= char <= 0x50 for char in encoded):
+            raise decode_error('malformed NetBIOS name')
+        raw = bytes(((encoded[i] - 0x41) << 4) | (encoded[i + 1] - 0x41) for i in range(0, 32, 2))
+        offset += 33
+        ## Skip any scope labels up to the terminating zero
+        while payload[offset]:
+            offset += payload[offset] + 1
+        return '%s<%02x>' % (raw[:15].decode('ascii', 'replace').rstrip(' '), raw[15]), offset + 1
+
+    def _browser(self, payload, protocols, values):
+        message_type = payload[0]
+        ## Direct unique / direct group / broadcast datagrams carry the names and an SMB payload
+        if message_type not in (0x10, 0x11, 0x12):
+            return False
+        if len(payload) < 14:
+            raise decode_error('short NetBIOS datagram header')
+        source_ip = socket.inet_ntoa(payload[4:8])
+        source_name, offset = self._netbios_name(payload, 14)
+        offset = self._netbios_name(payload, offset)[1]
+        smb = offset
+        if payload[smb:smb + 4] != b'\xffSMB' or payload[smb + 4] != 0x25:
+            return False
+        word_count = payload[smb + 32]
+        words = smb + 33
+        data_offset = struct.unpack_from('<H', payload, words + 24)[0]
+        mailslot_start = words + 2 * word_count + 2
+        mailslot_end = payload.find(b'\x00', mailslot_start)
+        if mailslot_end < 0:
+            raise decode_error('unterminated mailslot name')
+        mailslot = payload[mailslot_start:mailslot_end]
+        if mailslot.upper() != b'\\MAILSLOT\\BROWSE':
+            return False
+        browser = smb + data_offset
+        command = payload[browser]
+        values.update({'nbdgm.src.ip': [source_ip], 'nbdgm.source_name': [source_name], 'browser.command': ['0x%02x' % command]})
+        ## Host, local master and domain announcements share one layout
+        if command in (0x01, 0x0c, 0x0f) and len(payload) >= browser + 24:
+            server = payload[browser + 6:browser + 22].split(b'\x00', 1)[0]
+            values.update({'browser.server': [server.decode('ascii', 'replace')],
+                           'browser.os_major': [str(payload[browser + 22])], 'browser.os_minor': [str(payload[browser + 23])]})
+        protocols += ['nbdgm', 'smb', 'mailslot', 'browser']
+        return True
@@ -0,0 +1,40 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class tokenbucket:
+    def __init__(self, rate, burst=None):
+        ## 'rate' tokens per second (0 or less disables the limit); up to 'burst' tokens may be spent at once
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.granted = 0
+        self.shed = 0
+        self.waited = 0.0
+
+    ## Reserve one token and return the seconds the caller must wait before using it,
+    ## or None (nothing reserved) when that wait would exceed 'max_wait'
+    def reserve(self, max_wait=None):
+        if self.rate <= 0:
+            self.granted += 1
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and delay > max_wait:
+                self.shed += 1
+                return None
+            ## Tokens may go negative: later callers queue behind earlier reservations
+            self.tokens -= 1
+            self.granted += 1
+            self.waited += delay
+        return delay
+
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'granted': self.granted, 'shed': self.shed, 'waited': round(self.waited, 3)}
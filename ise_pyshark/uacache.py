@@ -0,0 +1,55 @@
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+## Fields derived from a User-Agent string that the protocol parsers act on
+useragent = namedtuple('useragent', ['os_family', 'os_version', 'brand', 'model', 'is_pc', 'is_tablet', 'is_mobile'])
+
+## user_agents compiles a large regex table on import; defer it until the first User-Agent string is parsed
+ua_parse = None
+
+class uacache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    ## Parse a User-Agent string into the derived OS, model and device-class values
+    @staticmethod
+    def parse(ua_string):
+        global ua_parse
+        if ua_parse is None:
+            from user_agents import parse as ua_parse
+        user_agent = ua_parse(ua_string)
+        return useragent(user_agent.os.family, user_agent.os.version_string,
+                         user_agent.device.brand, user_agent.device.model,
+                         user_agent.is_pc, user_agent.is_tablet, user_agent.is_mobile)
+
+    ## Return the derived values for 'ua_string', parsing and caching it (LRU) on a miss
+    def get(self, ua_string):
+        with self.lock:
+            result = self.entries.get(ua_string)
+            if result is not None:
+                self.entries.move_to_end(ua_string)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = self.parse(ua_string)
+        with self.lock:
+            self.entries[ua_string] = result
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,101 @@
+import os
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class unknownmodels:
+    def __init__(self, file='unknown_models.txt', flush_interval=5.0, batch_size=100):
+        self.file = file
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        ## record -> [count, first_seen, last_seen]
+        self.records = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.writer = None
+        self.running = False
+        self._load()
+
+    ## Seed the in-memory index once from any existing file
+    def _load(self):
+        try:
+            with open(self.file, 'r') as file:
+                lines = [l.strip() for l in file.readlines()]
+        except FileNotFoundError:
+            # If the file doesn't exist, consider it as an empty file
+            return
+        for line in lines:
+            if not line:
+                continue
+            ## Lines are 'mac | protocol | ip | vendor | model', optionally followed by ' | count | first_seen | last_seen'
+            fields = line.split(' | ')
+            count, first_seen, last_seen = 1, '', ''
+            if len(fields) >= 8 and fields[-3].isdigit():
+                count, first_seen, last_seen = int(fields[-3]), fields[-2], fields[-1]
+                line = ' | '.join(fields[:-3])
+            self.records.setdefault(line, [count, first_seen, last_seen])
+        logger.debug(f'loaded {len(self.records)} unknown model records from {self.file}')
+
+    ## Record an unknown model observation; only the in-memory index is touched on the packet path
+    def record(self, values):
+        record = values[0] + ' | ' + values[1] + ' | ' + values[2] + ' | ' + values[5] + ' | ' + values[8]
+        record = record.strip()
+        now = datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            entry = self.records.get(record)
+            if entry is None:
+                self.records[record] = [1, now, now]
+                logger.info(f"Unknown model recorded: {record}")
+            else:
+                entry[0] += 1
+                entry[2] = now
+            self.pending += 1
+            pending = self.pending
+        if self.writer is None:
+            self.start()
+        if pending >= self.batch_size:
+            self.wake.set()
+
+    def start(self):
+        with self.lock:
+            if self.writer is not None:
+                return
+            self.running = True
+            self.writer = threading.Thread(target=self._run, name='unknown-models-writer', daemon=True)
+            self.writer.start()
+        atexit.register(self.close)
+
+    ## Background writer: flush every 'flush_interval' seconds, or sooner once 'batch_size' records are pending
+    def _run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    ## Rewrite the file with current counts and timestamps (atomic replace) if anything changed
+    def flush(self):
+        with self.lock:
+            if self.pending == 0:
+                return
+            lines = [f'{record} | {count} | {first_seen} | {last_seen}\n' for record, (count, first_seen, last_seen) in self.records.items()]
+            self.pending = 0
+        temp_file = self.file + '.tmp'
+        try:
+            with open(temp_file, 'w') as file:
+                file.writelines(lines)
+            os.replace(temp_file, self.file)
+        except OSError as e:
+            logger.warning(f'unable to write unknown models file {self.file} - {e}')
+            with self.lock:
+                self.pending += 1                   # Keep the data dirty so the next cycle retries
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        if self.writer is not None and self.writer is not threading.current_thread():
+            self.writer.join(timeout=self.flush_interval)
+        self.flush()
@@ -50,6 +50,9 @@ setup (
         'user-agents>=2.2.0',
         'versioneer>=0.29'
     ],
+    extras_require={
+        'async': ['aiohttp>=3.9'],
+    },
     include_package_data=True,
     platforms=['OS X','Linux','Windows'],
     keywords=['ISE', 'API', 'IOT', 'profiling'],